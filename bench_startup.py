@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Startup benchmark for the single action path of edir.py 
+(e.g. python edir.py update --username ...).
+
+Usage: 
+    python bench_startup.py [--runs 20] [--max-ms 150]
+
+It times a single action that stops before connecting to LDAP 
+(a value is missing), next to a bare interpreter start, and checks 
+that importing edir does not load the modules only batch runs, mail 
+and storage requests need (beyond what ldap and logging load). 
+Exits with 1 if the median startup overhead is above --max-ms or 
+such a module got loaded, so it can run after each change to catch 
+startup regressions.
+
+Run it from a copy of the script with its settings.py next to it. 
+It works in a scratch directory, so edir.log is left alone.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+# Modules the single action path should not import up front
+DEFERRED = ['json', 'csv', 'argparse', 'textwrap', 'smtplib', 'urllib2', 
+            'socket', 'urlparse', 'cProfile', 'pstats']
+
+# What edir needs anyway, these may load some of the above themselves
+EAGER = "import logging, ldap, ldap.controls, ldap.filter, base64, zlib, " \
+        "heapq, importlib"
+
+
+def timeCommand(command, cwd, runs):
+    """Wall times (ms) of runs of a command, best of them first"""
+
+    times = []
+    devnull = open(os.devnull, 'w')
+    for _i in range(runs):
+        start = time.time()
+        subprocess.call(command, cwd=cwd, stdout=devnull, stderr=devnull)
+        times.append((time.time() - start) * 1000)
+    devnull.close()
+    return sorted(times)
+
+
+def main(argv):
+    """This is the main body of the script"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20, 
+                        help="Number of runs of each command")
+    parser.add_argument("--max-ms", type=float, default=150, 
+                        help="Highest acceptable median startup overhead")
+    args = parser.parse_args(argv[1:])
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(here, "edir.py")
+    scratch = tempfile.mkdtemp()
+
+    try:
+        # Modules loaded by importing edir, on top of its dependencies
+        check = "import sys; sys.path.insert(0, {0!r}); {1}; " \
+                "before = set(sys.modules); import edir; " \
+                "print(' '.join(m for m in {2!r} if m not in before " \
+                "and type(sys.modules.get(m)).__name__ == 'module'))" \
+                .format(here, EAGER, DEFERRED)
+        loaded = subprocess.check_output([sys.executable, "-c", check], 
+                                            cwd=scratch).split()
+
+        bare = timeCommand([sys.executable, "-c", "pass"], scratch, args.runs)
+        single = timeCommand([sys.executable, script, "update", 
+                                "--username", "benchmark"], 
+                                scratch, args.runs)
+    finally:
+        shutil.rmtree(scratch)
+
+    median = lambda times: times[len(times) // 2]
+    overhead = median(single) - median(bare)
+
+    print("interpreter start:  best {0:7.1f}ms  median {1:7.1f}ms" \
+            .format(bare[0], median(bare)))
+    print("single action:      best {0:7.1f}ms  median {1:7.1f}ms" \
+            .format(single[0], median(single)))
+    print("startup overhead:   {0:.1f}ms (limit {1:.0f}ms)" \
+            .format(overhead, args.max_ms))
+
+    failed = False
+    if loaded:
+        print("FAIL: importing edir loads {0}".format(", ".join(loaded)))
+        failed = True
+    if overhead > args.max_ms:
+        print("FAIL: startup overhead above {0:.0f}ms".format(args.max_ms))
+        failed = True
+    if not failed:
+        print("OK")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -8,11 +8,40 @@ and quota provisioning.
 
 Usage: 
     python edir.py -f input.json -o output.csv
+    python edir.py <action> --username testuserj [--field value ...]
+    python edir.py sweep -o swept.csv [--days 30] [--purge] [--record TRACE]
 
 Options:
     -h --help
     -f --file	Input file (required)
     -o --out	Output file (required)
+    --plan	Only report the LDAP/HTTP/SMTP operations each row would 
+    		perform, with totals and a runtime estimate; write nothing
+    --ldif	Write the changes to an LDIF file for bulk import 
+    		instead of making them in eDir
+    --requests	Companion CSV of storage requests and notifications 
+    		for --ldif (default: LDIF file name + .requests.csv)
+    --deadline	Run budget in seconds, rows not started by then are 
+    		written to the output file as DEFERRED
+    --spool	Shared directory (e.g. on NFS) through which several 
+    		workers run one input file together, see below
+    --profile	Profile the run: PREFIX.txt gets wall time (and process 
+    		CPU time) per action type and helper and the cProfile 
+    		hotspots, PREFIX.folded the sampled stacks for flame 
+    		graphs (e.g. flamegraph.pl)
+    --record	Write every LDAP operation of the run, with its timing 
+    		and result (passwords redacted), to a trace file that 
+    		replay.py plays against an in-memory directory
+
+The second form carries out a single action (e.g. for an IDM driver 
+event) with the input file fields as options, prints the result and 
+exits with 0 on SUCCESS. It skips the file handling and only imports 
+what the action uses; bench_startup.py measures its startup time.
+
+The third form archives the users of STUDENTOU/EMPOU that have been 
+disabled and unchanged for --days (SWEEPDAYS), found on the server 
+instead of listed in an input file. With --purge it deletes such users 
+from the _Archive containers.
 
 Environment specific script constants are stored in this 
 config file: settings.py
@@ -52,36 +81,117 @@ Output file (e.g. output.csv) will have these fields:
 
 action, username, result (ERROR/SUCCESS: reason)
 
+Rows are run most urgent first, disables and deletes before renames 
+and updates, then creates and archives (PRIORITIES and DEADLINES in 
+settings.py). The rows of one user keep their order, and the output 
+file keeps the order of the input file.
+
+Workers:
+
+To spread a large input over several processes or hosts, start the 
+same command with the same --spool directory on each of them. The 
+first worker splits the input into PARTITIONS partitions by user, 
+then every worker claims partitions with lease files and runs them. 
+A partition whose lease is not renewed for LEASETIME seconds (e.g. 
+its worker crashed) is taken over by another worker, which skips the 
+rows already done. When all partitions are done each worker writes 
+the merged results to the output file. Use a new spool directory 
+for each input file.
+
 Logging:
 
 Script creates a detailed edir.log
 
 All errors are also printed to stdout.
 
+Embedding:
+
+Other programs can import this script, build a Provisioner per 
+directory tree from a settings object (like settings.py) and pass 
+user actions to its apply() method, which yields the results as the 
+actions complete. A list of actions is scheduled as one batch, a 
+generator (e.g. of IDM driver events) is run as it produces them. 
+The uidNumber/gidNumber index and the supported controls a 
+Provisioner reads are kept for CACHETIME seconds, users and group 
+memberships are read for every action.
+
 Author: A. Ablovatski
 Email: ablovatskia@denison.edu
 Date: 10/31/2016
 """
 
 from __future__ import print_function
+import os
+import errno
 import time
+import heapq
 import sys
 import traceback
-import json
-import csv
-import argparse
+import threading
+import importlib
 import logging
 import ldap
-import ldap.modlist as modlist
-import urllib
-import textwrap
-import smtplib
+import ldap.controls
+import ldap.filter
 import base64
+import zlib
+
+
+class LazyModule(object):
+    """Stands in for a module and imports it on first use, so 
+    a single action only pays for the modules it needs"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Only some runs need these (batch files, mail, storage requests, 
+# --plan, --spool, --profile), import them when they are used
+json = LazyModule('json')
+csv = LazyModule('csv')
+argparse = LazyModule('argparse')
+urllib2 = LazyModule('urllib2')
+textwrap = LazyModule('textwrap')
+smtplib = LazyModule('smtplib')
+socket = LazyModule('socket')
+urlparse = LazyModule('urlparse')
+cProfile = LazyModule('cProfile')
+pstats = LazyModule('pstats')
+gzip = LazyModule('gzip')
+
+
+# OID of the LDAP Assertion control (RFC 4528)
+ASSERTIONCONTROL = '1.3.6.1.1.12'
+
+# HR-provided primOU -> department group translation dictionary
+DEPTGROUPS = {
+    'Admissions': 'Admissions',
+    'Art': 'Art',
+    'History': 'History',
+    'Biology': 'Biology',
+    'Chemistry': 'Chemistry',
+    'Cinema': 'Cinema',
+    'Classical Studies': 'Classics',
+    'English': 'English',
+    'Library': 'Library',
+    'Museum': 'Museum',
+    'Music': 'Music',
+    'Philosophy': 'Philosophy',
+    'Religion': 'Religion',
+    'Theatre': 'Theatre',
+}
 
 
-def main(argv):
-    """This is the main body of the script"""
-    
+def setup():
+    """Set up the log file and a Provisioner from the 
+    settings file, returns None if that fails"""
+
     # Setup the log file
     logging.basicConfig(
         filename='edir.log',level=logging.DEBUG, 
@@ -91,9 +201,19 @@ def main(argv):
     # Get LDAP creds and other constants from this settings file
     config_file = 'settings.py'
     
-    if not readConfig(config_file):
+    provisioner = readConfig(config_file)
+    if not provisioner:
         print("unable to process the settings file")
         logging.error("unable to process the settings file")
+
+    return provisioner
+
+
+def main(argv):
+    """This is the main body of the script"""
+    
+    provisioner = setup()
+    if not provisioner:
         sys.exit()
     
     # Parse script arguments
@@ -103,6 +223,28 @@ def main(argv):
                         help="Input JSON file with user actions and params")
     parser.add_argument("--out", "-o", type=str, required=True, 
                         help="Output file with results of eDir user actions")
+    parser.add_argument("--plan", action="store_true", 
+                        help="Only report the operations the input would " \
+                        "perform and estimate the runtime, write nothing")
+    parser.add_argument("--ldif", type=str, 
+                        help="Write the changes to this LDIF file for " \
+                        "bulk import instead of making them in eDir")
+    parser.add_argument("--deadline", type=float, 
+                        help="Run budget in seconds, actions not started " \
+                        "by then are deferred")
+    parser.add_argument("--spool", type=str, 
+                        help="Shared directory to split the input with " \
+                        "other workers running the same command")
+    parser.add_argument("--profile", type=str, metavar="PREFIX", 
+                        help="Profile the run, write PREFIX.txt (hotspots) " \
+                        "and PREFIX.folded (stacks for flame graphs)")
+    parser.add_argument("--record", type=str, metavar="TRACE", 
+                        help="Write the LDAP operations of the run to this " \
+                        "trace file for replay.py (gzipped if it ends in .gz)")
+    parser.add_argument("--requests", type=str, 
+                        help="CSV file for the storage requests and " \
+                        "notifications of --ldif mode " \
+                        "(default: LDIF file name + .requests.csv)")
 
     try:
         args = parser.parse_args()
@@ -117,6 +259,67 @@ def main(argv):
     # Write output to csv file
     out_file = args.out
     
+    # Trace the LDAP operations for replay.py
+    if args.record:
+        try:
+            provisioner.recorder = Recorder(args.record, 
+                                            provisioner.LDAPSERVER)
+        except IOError:
+            print("ERROR: Unable to open trace file!")
+            logging.critical("unable to open trace file: {0}" \
+                                .format(args.record))
+            sys.exit()
+    
+    # Time actions and helpers, collect stacks
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile)
+        profiler.start(provisioner)
+    
+    # Several workers share the input through a spool directory
+    if args.spool:
+        if args.plan or args.ldif:
+            print("ERROR: --spool can't be combined with --plan or --ldif")
+            logging.error("--spool can't be combined with --plan or --ldif")
+            sys.exit()
+        try:
+            spool = Spool(args.spool, provisioner.PARTITIONS, 
+                            provisioner.LEASETIME, provisioner.LEASEPOLL)
+            spool.split(in_file, provisioner)
+            spool.work(provisioner, args.deadline)
+            spool.merge(out_file)
+        except (IOError, OSError), e:
+            print("ERROR: Unable to use spool directory: {0}".format(e))
+            logging.critical("unable to use spool directory {0}: {1}" \
+                                .format(args.spool, e))
+        finally:
+            if profiler:
+                profiler.stop(provisioner)
+            provisioner.close()
+        return
+
+    # Collect operations instead of writing in --plan and --ldif mode
+    if args.plan or args.ldif:
+        provisioner.planner = Planner(provisioner)
+    
+    if args.ldif:
+        try:
+            provisioner.planner.exportTo(args.ldif, 
+                            args.requests or args.ldif + ".requests.csv")
+        except IOError:
+            print("ERROR: Unable to open LDIF/requests output file!")
+            logging.critical("unable to open output file: {0}" \
+                                .format(args.ldif))
+            sys.exit()
+    
+    if args.plan:
+        try:
+            provisioner.planner.probe()
+        except ldap.LDAPError, e:
+            print("ERROR: unable to probe LDAP server latency: {0}".format(e))
+            logging.error("unable to probe LDAP server latency: {0}" \
+                            .format(e))
+    
     try:
         f_in = open(in_file, 'rb')
         logging.info("opened input file: {0}".format(in_file))
@@ -126,38 +329,28 @@ def main(argv):
         writer = csv.writer(f_out)
         writer.writerow( ['action','username','result'] )
         
-        for row in reader["useractions"]:
-            result = ''
-            # Select what needs to be done
-            if row["action"] == 'create':
-                result = create(str(row["username"]), str(row["loginDisabled"]), 
-                                str(row["uidNumber"]), str(row["gidNumber"]), 
-                                str(row["givenName"]), str(row["fullName"]), 
-                                str(row["sn"]), str(row["employeeType"]), 
-                                str(row["DNumber"]), 
-                                str(row["x500UniqueIdentifier"]), 
-                                str(row["primO"]), str(row["businessCategory"]), 
-                                str(row["userPassword"]), str(row["description"]))
-            elif row["action"] == 'update':
-                result = update(str(row["username"]), str(row["newusername"]), 
-                                str(row["loginDisabled"]), str(row["uidNumber"]), 
-                                str(row["gidNumber"]), str(row["givenName"]), 
-                                str(row["fullName"]), str(row["sn"]), 
-                                str(row["employeeType"]), str(row["DNumber"]), 
-                                str(row["x500UniqueIdentifier"]), 
-                                str(row["primO"]), str(row["businessCategory"]), 
-                                str(row["description"]))
-            elif row["action"] == 'delete':
-                 result = delete(str(row["username"]))
-            elif row["action"] == 'archive':
-                 result = archive(str(row["username"]))
-            else:
-                print("ERROR: unrecognized action: {0}".format(row["action"]))                
-                logging.error("unrecognized action: {0}".format(row["action"]))
-                result = "ERROR: Unrecognized action."
+        # Results come urgent ones first, we write them in input order
+        actions = {}
+        results = {}
+        written = 0
+        
+        for index, action, result in provisioner.apply(reader["useractions"], 
+                                                        args.deadline):
+            # In --plan mode the result lists the planned operations
+            if args.plan:
+                result = provisioner.planner.describeRow(result)
+            actions[index] = action
+            results[index] = result
             
-            # Write the result to the output csv file
-            writer.writerow([row["action"], row["username"], result])
+            # Write the results to the output csv file in input order
+            while written in results:
+                action = actions.pop(written)
+                writer.writerow([action.action, action.username, 
+                                results.pop(written)])
+                written += 1
+        
+        if args.plan:
+            provisioner.planner.report()
             
     except IOError:
         print("ERROR: Unable to open input/output file!")
@@ -173,6 +366,9 @@ def main(argv):
                 "{1}".format(fname,e))
                 
     finally:
+        if profiler:
+            profiler.stop(provisioner)
+        provisioner.close()
         f_in.close()
         logging.info("closed input file: {0}".format(in_file))
         f_out.close()
@@ -180,17 +376,596 @@ def main(argv):
         
     return
 
+
+def runOne(argv):
+    """Carry out one action given on the command line, e.g. 
+    edir.py update --username jdoe --loginDisabled False ... 
+    Prints the result, returns the exit status (0 on SUCCESS)."""
+
+    provisioner = setup()
+    if not provisioner:
+        return 2
+
+    # Input file fields as --field value pairs
+    row = {"action": argv[1]}
+    args = argv[2:]
+    while args:
+        option = args.pop(0)
+        if not option.startswith("--") or not args:
+            print("ERROR: expected --field value, got {0}".format(option))
+            logging.error("bad single action argument: {0}".format(option))
+            return 2
+        row[option[2:]] = args.pop(0)
+    row.setdefault("newusername", row.get("username", ""))
+
+    result = "ERROR: no result."
+    try:
+        action = provisioner.parseAction(row)
+        # Look up just our numbers instead of loading the whole index
+        if provisioner.IDCHECK and action.action in ('create', 'update') \
+                and not action.missing():
+            provisioner.lookupIds([action])
+        for _index, _action, result in provisioner.apply([action]):
+            print(result)
+    finally:
+        provisioner.close()
+
+    return 0 if result.startswith("SUCCESS") else 1
+
+
+def runSweep(argv):
+    """Archive (or purge from _Archive) the users disabled for 
+    a while, e.g. edir.py sweep -o swept.csv --days 30"""
+
+    provisioner = setup()
+    if not provisioner:
+        return 2
+
+    parser = argparse.ArgumentParser(prog="edir.py sweep")
+    parser.add_argument("--out", "-o", type=str, required=True, 
+                        help="Output file with results of the sweep")
+    parser.add_argument("--days", type=float, default=provisioner.SWEEPDAYS, 
+                        help="Only users disabled and unchanged for this " \
+                        "many days (default: SWEEPDAYS)")
+    parser.add_argument("--purge", action="store_true", 
+                        help="Delete such users from the _Archive " \
+                        "containers instead of archiving them")
+    parser.add_argument("--record", type=str, metavar="TRACE", 
+                        help="Write the LDAP operations of the sweep to " \
+                        "this trace file for replay.py")
+    args = parser.parse_args(argv[2:])
+
+    swept = 0
+    f_out = None
+    try:
+        if args.record:
+            provisioner.recorder = Recorder(args.record, 
+                                            provisioner.LDAPSERVER)
+        f_out = open(args.out, 'wb')
+        logging.info("opened output file: {0}".format(args.out))
+        writer = csv.writer(f_out)
+        writer.writerow( ['action','username','result'] )
+        for kind, username, result in provisioner.sweep(args.days, 
+                                                        args.purge):
+            writer.writerow([kind, username, result])
+            swept += result.startswith("SUCCESS")
+
+    except IOError:
+        print("ERROR: Unable to open output/trace file!")
+        logging.critical("unable to open output file: {0} or trace file: " \
+                            "{1}".format(args.out, args.record))
+        return 2
+
+    except ldap.LDAPError, e:
+        print("ERROR: sweep failed: {0}".format(e))
+        logging.error("sweep failed: {0}".format(e))
+        return 1
+
+    finally:
+        # Also keeps the rows of a sweep that failed half way
+        if f_out:
+            f_out.close()
+            logging.info("closed output file: {0}".format(args.out))
+        provisioner.close()
+
+    print("SUCCESS: swept {0} users".format(swept))
+    logging.info("swept {0} users".format(swept))
+    return 0
+
+
+def readConfig(config_file):
+    """Function to import the config file 
+    and set up a Provisioner with it"""
     
-def create(username, loginDisabled, uidNumber, gidNumber, givenName, fullName, 
-            sn, employeeType, dNumber, x500UniqueIdentifier, ou, 
-            businessCategory, userPassword, description):
-    """This funtion adds users to eDir"""
+    if config_file[-3:] == ".py":
+        config_file = config_file[:-3]
+    settings = __import__(config_file, globals(), locals(), [])
     
-    # Check if any of the parameters are missing
-    params = locals()
+    # Read settings
+    try: 
+        provisioner = Provisioner(settings)
+
+    except Exception as e:
+        logging.error("unable to parse settings file: {0}".format(e))
+        print("ERROR: unable to parse the settings file: {0}".format(e))
+        return None
+        
+    return provisioner
+
     
-    for _item in params:
-        if str(params[_item]) == "":
+class Provisioner(object):
+    """Manages the users of one eDirectory tree, as described by a 
+    settings object (e.g. the settings.py module). It owns its LDAP 
+    connection and caches, so several trees can be provisioned from 
+    one long-lived process, each with its own Provisioner.
+
+    What it reads from the server is kept for CACHETIME seconds: the 
+    uidNumber/gidNumber index (which it also updates after each of its 
+    own writes) and the supported controls. A batch started later reads 
+    them again. Users and group memberships are read fresh for every 
+    action and never cached."""
+
+    def __init__(self, settings):
+        """Read the settings"""
+
+        self.LDAPSERVER = settings.LDAPSERVER
+        self.USER = settings.USER
+        self.PASSWORD = base64.b64decode(settings.PASSWORD)
+        self.baseDN = settings.BASEDN
+        self.MAILDOMAIN = settings.MAILDOMAIN
+        self.STUPATTERN = settings.STUPATTERN
+        self.GSTPATTERN = settings.GSTPATTERN
+        self.ARUBAPATTERN = settings.ARUBAPATTERN
+        self.STUSERVER = settings.STUSERVER
+        self.EMPSERVER = settings.EMPSERVER
+        self.SHAREOU = settings.SHAREOU
+        self.STUDENTOU = settings.STUDENTOU
+        self.GUESTOU = settings.GUESTOU
+        self.EMPOU = settings.EMPOU
+        self.DEPGROUPOU = settings.DEPGROUPOU
+        self.GeneralMacUsersOU = settings.GeneralMacUsersOU
+        self.StuGeneralMacUsers = settings.StuGeneralMacUsers
+        self.GuestGeneralMacUsers = settings.GuestGeneralMacUsers
+        self.EmpGeneralMacUsers = settings.EmpGeneralMacUsers
+        self.EmpGeneralWSUsers = settings.EmpGeneralWSUsers
+        self.FROM = settings.FROM
+        self.TO = settings.TO
+        self.MAILSERVER = settings.MAILSERVER
+        self.RECONNECTS = getattr(settings, 'RECONNECTS', 3)
+        self.RECONNECTDELAY = getattr(settings, 'RECONNECTDELAY', 2)
+        self.PLANWRITEFACTOR = getattr(settings, 'PLANWRITEFACTOR', 2.0)
+        self.USECONTROLS = getattr(settings, 'USECONTROLS', True)
+        self.PRIORITIES = getattr(settings, 'PRIORITIES', {'disable': 0, 
+                                    'rename': 1, 'update': 1, 'create': 2, 
+                                    'archive': 3})
+        self.DEADLINES = getattr(settings, 'DEADLINES', {})
+        self.IDCHECK = getattr(settings, 'IDCHECK', True)
+        self.PAGESIZE = getattr(settings, 'PAGESIZE', 500)
+        self.CACHETIME = getattr(settings, 'CACHETIME', 300)
+        self.NETWORKTIMEOUT = getattr(settings, 'NETWORKTIMEOUT', 10)
+        self.OPTIMEOUT = getattr(settings, 'OPTIMEOUT', 60)
+        self.HTTPTIMEOUT = getattr(settings, 'HTTPTIMEOUT', 30)
+        self.PARTITIONS = getattr(settings, 'PARTITIONS', 16)
+        self.LEASETIME = getattr(settings, 'LEASETIME', 300)
+        self.LEASEPOLL = getattr(settings, 'LEASEPOLL', 5)
+        self.SWEEPDAYS = getattr(settings, 'SWEEPDAYS', 30)
+        self.SWEEPWINDOW = getattr(settings, 'SWEEPWINDOW', 16)
+        self.STARTTLS = getattr(settings, 'STARTTLS', False)
+        self.TLSCACERTFILE = getattr(settings, 'TLSCACERTFILE', '')
+        self.TLSCERTFILE = getattr(settings, 'TLSCERTFILE', '')
+        self.TLSKEYFILE = getattr(settings, 'TLSKEYFILE', '')
+        self.TLSREQUIRECERT = getattr(settings, 'TLSREQUIRECERT', 'demand')
+
+        # Our LDAP connection, opened on first use
+        self.connection = None
+        # Controls the LDAP server supports, read from the root DSE 
+        # on first use, and when they were read
+        self.supportedControls = None
+        self.controlsLoaded = None
+        # Set in --plan/--ldif mode to collect operations instead of writing
+        self.planner = None
+        # Set in --record mode to trace the LDAP operations
+        self.recorder = None
+        # uidNumber/gidNumber -> dn of the tree, loaded on first use, 
+        # dn (lowercase) -> its (uidNumber, gidNumber) to update it in 
+        # place, and when it was loaded
+        self.uidIndex = None
+        self.gidIndex = None
+        self.idOwners = {}
+        self.idLoaded = None
+        # TLS setup shared by all our connections to the LDAP server
+        self.tls = TLSContext(self.TLSCACERTFILE, self.TLSCERTFILE, 
+                                self.TLSKEYFILE, self.TLSREQUIRECERT, 
+                                self.STARTTLS)
+
+    def close(self):
+        """Disconnect from the LDAP server and close planner outputs"""
+
+        if self.connection:
+            # Its nice to the server to disconnect when done
+            try:
+                self.connection.unbind_s()
+            except ldap.LDAPError, e:
+                logging.warning("problem unbinding from eDir LDAP " \
+                                "server: {0}".format(e))
+            self.connection = None
+
+        if self.planner:
+            self.planner.close()
+
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+        if self.tls.handshakes:
+            logging.info("TLS handshakes: {0} in {1:.3f}s" \
+                            .format(self.tls.handshakes, self.tls.elapsed))
+
+    def bind(self):
+        """Open a new connection to the LDAP server 
+        that rebinds by itself if the connection drops"""
+
+        return ReconnectingLDAP(self.LDAPSERVER, self.USER, self.PASSWORD, 
+                                self.RECONNECTS, self.RECONNECTDELAY, 
+                                self.NETWORKTIMEOUT, self.OPTIMEOUT, 
+                                self.tls)
+
+    def apply(self, actions, deadline=None):
+        """Carry out user actions (UserAction records or input file rows), 
+        most urgent first. Yields (index, action, result) as each one 
+        completes, where index is its position in actions. Actions not 
+        started within deadline seconds are deferred. A list is run as 
+        one batch; any other iterable (e.g. a generator of IDM events) 
+        is run an action at a time, as the actions arrive."""
+
+        if deadline is not None:
+            deadline = time.time() + deadline
+        deferred = 0
+
+        if isinstance(actions, list):
+            batches = [list(enumerate(actions))]
+        else:
+            batches = ([(index, action)] for index, action 
+                        in enumerate(actions))
+
+        for batch in batches:
+            for index, action, result in self.runBatch(batch, deadline):
+                if result.startswith("DEFERRED"):
+                    deferred += 1
+                yield index, action, result
+
+        if deferred:
+            print("WARNING: run deadline reached, deferred {0} actions" \
+                    .format(deferred))
+            logging.warning("run deadline reached, deferred {0} actions" \
+                            .format(deferred))
+
+    def runBatch(self, batch, deadline):
+        """Run a batch of (index, action or row) pairs 
+        most urgent first, see apply()"""
+
+        # Rows that fail before running list no planned operations
+        if self.planner:
+            self.planner.startRow()
+
+        self.refresh()
+
+        indexes = []
+        actions = []
+        for index, action in batch:
+            if not isinstance(action, UserAction):
+                try:
+                    action = self.parseAction(action)
+                except Exception as e:
+                    # A broken row fails on its own, the rest still run
+                    print("ERROR: unable to parse input row {0}: {1}" \
+                            .format(index + 1, e))
+                    logging.error("unable to parse input row {0}: {1}" \
+                                    .format(index + 1, e))
+                    # with what we can tell of it, for the output file
+                    failed = self.parseAction({})
+                    if isinstance(action, dict):
+                        failed.action = text(action.get("action", ""))
+                        failed.username = text(action.get("username", ""))
+                    yield index, failed, "ERROR: Unable to parse input row."
+                    continue
+            indexes.append(index)
+            actions.append(action)
+
+        # Rows with uidNumber/gidNumber conflicts are reported before 
+        # any write and skipped
+        conflicts = {}
+        if self.IDCHECK:
+            conflicts = self.checkIds(actions)
+        for i in sorted(conflicts):
+            yield indexes[i], actions[i], conflicts[i]
+
+        scheduler = Scheduler(actions, self.PRIORITIES, self.DEADLINES)
+
+        for i in scheduler:
+            action = actions[i]
+            if i in conflicts:
+                scheduler.done(i)
+                continue
+            if self.planner:
+                self.planner.startRow()
+            # Out of time, leave the rest for the next run
+            if deadline is not None and time.time() > deadline:
+                scheduler.done(i)
+                yield indexes[i], action, "DEFERRED: run deadline " \
+                                            "reached, not attempted."
+                continue
+            if self.recorder:
+                self.recorder.users = [action.username]
+                if action.newusername not in ("", action.username):
+                    self.recorder.users.append(action.newusername)
+            result = self.runAction(action)
+            if self.recorder:
+                self.recorder.users = None
+            # Later rows resolve against the planned state of their user
+            if self.planner and scheduler.last(i):
+                self.planner.forget(action)
+            scheduler.done(i)
+            if self.IDCHECK and result.startswith("SUCCESS"):
+                self.indexIds(action)
+            yield indexes[i], action, result
+
+    def refresh(self):
+        """Drop what was read from the server more than CACHETIME ago, 
+        so a long-lived Provisioner reads it again and sees the 
+        changes others made to the tree"""
+
+        if self.idLoaded is not None and \
+                time.time() - self.idLoaded > self.CACHETIME:
+            logging.info("uidNumber/gidNumber index is {0:.0f}s old, " \
+                            "reloading it".format(time.time() - self.idLoaded))
+            self.uidIndex = None
+            self.gidIndex = None
+            self.idOwners = {}
+            self.idLoaded = None
+
+        if self.controlsLoaded is not None and \
+                time.time() - self.controlsLoaded > self.CACHETIME:
+            self.supportedControls = None
+            self.controlsLoaded = None
+
+    def addIds(self, dn, attrs):
+        """Add the uidNumber/gidNumber values of an entry to the index"""
+
+        uidNumber = (attrs.get('uidNumber') or [None])[0]
+        gidNumber = (attrs.get('gidNumber') or [None])[0]
+        if uidNumber is not None:
+            self.uidIndex[uidNumber] = dn
+        if gidNumber is not None:
+            self.gidIndex[gidNumber] = dn
+        self.idOwners[dn.lower()] = (uidNumber, gidNumber)
+
+    def moveIds(self, dn, newdn=None):
+        """Move the index entries of dn to newdn (e.g. after a rename 
+        or archive), or drop them if newdn is None"""
+
+        ids = self.idOwners.pop(dn.lower(), None)
+        if not ids:
+            return
+        for numbers, number in zip((self.uidIndex, self.gidIndex), ids):
+            if number is None or \
+                    numbers.get(number, '').lower() != dn.lower():
+                continue
+            if newdn:
+                numbers[number] = newdn
+            else:
+                del numbers[number]
+        if newdn:
+            self.idOwners[newdn.lower()] = ids
+
+    def loadIdIndex(self):
+        """Load the uidNumber/gidNumber -> dn index 
+        of the tree with one paged search"""
+
+        self.uidIndex = {}
+        self.gidIndex = {}
+        self.idOwners = {}
+        self.idLoaded = time.time()
+
+        # In --plan/--ldif mode we read from the server behind the planner
+        l = self.ldapConnect()
+        if isinstance(l, PlanLDAP):
+            l = l.l
+        if not l:
+            logging.warning("unable to load uidNumber/gidNumber index, " \
+                            "checking the batch only")
+            return
+
+        start = time.time()
+        for dn, attrs in pagedSearch(l, self.baseDN, ldap.SCOPE_SUBTREE, 
+                                    "(|(uidNumber=*)(gidNumber=*))", 
+                                    ['uidNumber', 'gidNumber'], 
+                                    self.PAGESIZE):
+            self.addIds(dn, attrs)
+
+        logging.info("loaded {0} uidNumbers and {1} gidNumbers in {2:.1f}s" \
+                        .format(len(self.uidIndex), len(self.gidIndex), 
+                                time.time() - start))
+
+    def lookupIds(self, actions):
+        """Load the part of the uidNumber/gidNumber index that a few 
+        actions need, with one search instead of the whole tree"""
+
+        self.uidIndex = {}
+        self.gidIndex = {}
+        self.idOwners = {}
+        self.idLoaded = time.time()
+
+        l = self.ldapConnect()
+        if isinstance(l, PlanLDAP):
+            l = l.l
+        if not l:
+            return
+
+        # The values come from the command line or input file
+        escape = ldap.filter.escape_filter_chars
+        terms = []
+        for action in actions:
+            terms.append("(uidNumber=" + escape(action.uidNumber) + ")")
+            terms.append("(gidNumber=" + escape(action.gidNumber) + ")")
+        try:
+            for dn, attrs in l.search_s(self.baseDN, ldap.SCOPE_SUBTREE, 
+                                        "(|" + "".join(terms) + ")", 
+                                        ['uidNumber', 'gidNumber']):
+                self.addIds(dn, attrs)
+        except ldap.LDAPError, e:
+            logging.error("unable to look up uidNumber/gidNumber: {0}" \
+                            .format(e))
+            self.uidIndex = None
+            self.gidIndex = None
+            self.idLoaded = None
+
+    def checkIds(self, actions):
+        """Check the uidNumber/gidNumber of every create and update 
+        against the tree and the rest of the batch. Returns the 
+        results of the conflicting rows by index."""
+
+        # Rows with missing values fail without writing anything
+        checked = [a.action in ('create', 'update') and not a.missing() 
+                    for a in actions]
+        if not any(checked):
+            return {}
+
+        if self.uidIndex is None:
+            try:
+                self.loadIdIndex()
+            except ldap.LDAPError, e:
+                print("ERROR: unable to load uidNumber/gidNumber index, " \
+                        "checking the batch only: {0}".format(e))
+                logging.error("unable to load uidNumber/gidNumber index, " \
+                                "checking the batch only: {0}".format(e))
+                self.uidIndex = None
+                self.gidIndex = None
+                self.idLoaded = None
+        uidIndex = self.uidIndex or {}
+        gidIndex = self.gidIndex or {}
+
+        conflicts = {}
+        # Numbers claimed by earlier rows, with the user (by 
+        # x500UniqueIdentifier) and the row that claimed them
+        claimed = {'uidNumber': {}, 'gidNumber': {}}
+
+        for index, action in enumerate(actions):
+            if not checked[index]:
+                continue
+            own = (action.dn.lower(), action.newdn.lower())
+            for attr, numbers, number in [
+                    ('uidNumber', uidIndex, action.uidNumber), 
+                    ('gidNumber', gidIndex, action.gidNumber)]:
+                owner = numbers.get(number)
+                if owner and owner.lower() not in own:
+                    conflict = owner
+                else:
+                    claim = claimed[attr].setdefault(number, 
+                                    (action.x500UniqueIdentifier, index))
+                    if claim[0] == action.x500UniqueIdentifier:
+                        continue
+                    conflict = "row {0} of the batch".format(claim[1] + 1)
+                print("ERROR: {0} {1} of user {2} is already used by " \
+                        "{3}".format(attr, number, action.username, conflict))
+                logging.error("{0} {1} of user {2} is already used by " \
+                                "{3}".format(attr, number, action.username, 
+                                             conflict))
+                conflicts[index] = "ERROR: " + attr + " " + number + \
+                                    " is already used by " + conflict + "."
+                break
+
+        return conflicts
+
+    def indexIds(self, action):
+        """Keep the uidNumber/gidNumber index up to date after a write"""
+
+        if self.uidIndex is None:
+            return
+        if action.action in ('create', 'update'):
+            # The user's old numbers are free again
+            self.moveIds(action.dn)
+            self.moveIds(action.newdn)
+            self.addIds(action.newdn, {'uidNumber': [action.uidNumber], 
+                                        'gidNumber': [action.gidNumber]})
+        elif action.action == 'archive':
+            self.moveIds(action.dn, "cn=" + action.username + 
+                            self.archiveOU(action.userType))
+        elif action.action == 'delete':
+            self.moveIds(action.dn)
+
+    def runAction(self, action):
+        """Function to carry out a user action"""
+
+        # Select what needs to be done
+        if action.action == 'create':
+            result = self.create(action)
+        elif action.action == 'update':
+            result = self.update(action)
+        elif action.action == 'delete':
+            result = self.delete(action)
+        elif action.action == 'archive':
+            result = self.archive(action)
+        else:
+            print("ERROR: unrecognized action: {0}".format(action.action))
+            logging.error("unrecognized action: {0}".format(action.action))
+            result = "ERROR: Unrecognized action."
+
+        return result
+
+    def parseAction(self, row):
+        """Function to turn an input row into a UserAction"""
+
+        action = UserAction()
+        action.action = text(row.get("action", ""))
+        for name, field in UserAction.FIELDS:
+            setattr(action, name, text(row.get(field, "")))
+
+        # We never rename on create
+        if action.action == 'create' or action.newusername == "":
+            action.newusername = action.username
+
+        # Values derived from the username, built once per row
+        username = action.username
+        newusername = action.newusername
+        action.userType = self.getUserType(username)
+        action.dn = self.buildDN(username)
+        if newusername == username:
+            action.newdn = action.dn
+        else:
+            action.newdn = self.buildDN(newusername)
+        action.mail = newusername + self.MAILDOMAIN
+        action.homeDirectory = "/Users/" + newusername
+        action.gn, action.gdn = self.generalMacGroup(action.userType)
+
+        if action.userType == "STU":
+            action.homeServer = self.STUSERVER
+        elif action.userType == "GST":
+            action.homeServer = None
+        else:
+            action.homeServer = self.EMPSERVER
+
+        # Groups a new user goes into: GeneralMacUsers (and DeptGroup if exists)
+        action.groups = [action.gdn]
+        action.deptGroup = None
+        if action.userType == "EMP":
+            action.groups.append("cn=" + self.EmpGeneralWSUsers 
+                                 + self.GeneralMacUsersOU)
+            action.deptGroup = self.lookupGroup(action.ou)
+            if action.deptGroup:
+                action.groups.append(action.deptGroup)
+
+        return action
+
+    def create(self, action):
+        """This funtion adds users to eDir"""
+        
+        username = action.username
+        dn = action.dn
+        
+        # Check if any of the parameters are missing
+        _item = action.missing()
+        if _item:
             print("ERROR: unable to create user {0} because {1} is missing " \
                     "a value".format(username, _item))
             logging.error("unable to create user {0} because {1} is missing " \
@@ -199,179 +974,115 @@ def create(username, loginDisabled, uidNumber, gidNumber, givenName, fullName,
                         + " in input file."
             return result
 
-    # We have all we need, connect to LDAP
-    l = ldapConnect()
-    
-    # Catch LDAP connection failure
-    if not l:
-        result = "ERROR: unable to connect to LDAP server."
-        return result
-        
-    # Do a quick check if the user already exists
-    if findUser(l, username):
-        print("ERROR: cannot create user - user already exists: {0}" \
-                .format(username))
-        logging.error("cannot create user - user already exists: {0}" \
-                .format(username))
-        result = "ERROR: username already taken!"
-        return result
+        # We have all we need, connect to LDAP
+        l = self.ldapConnect()
         
-    # Create new user if it does not exist
-    try:
-        # Get the dn of our new user
-        dn = buildDN(username)
-        
-        # Set server and groups variables
-        userType = getUserType(username)
-        groups = []
-        if userType == "STU":
-            server = STUSERVER
-            gdn = "cn=" + StuGeneralMacUsers + GeneralMacUsersOU
-            groups = [gdn]
-        elif userType == "GST":
-            gdn = "cn=" + GuestGeneralMacUsers + GeneralMacUsersOU
-            groups = [gdn]
-        else:
-            server = EMPSERVER
-            gdn = "cn=" + EmpGeneralMacUsers + GeneralMacUsersOU
-            groups = [gdn]
-            gdn1 = "cn=" + EmpGeneralWSUsers + GeneralMacUsersOU
-            groups = groups + [gdn1]
-            # Find user's department group and add it here
-            deptGroup = lookupGroup(ou)
-            if deptGroup:
-                groups = groups + [deptGroup]
-            else:
+        # Catch LDAP connection failure
+        if not l:
+            result = "ERROR: unable to connect to LDAP server."
+            return result
+            
+        # Do a quick check if the username is taken anywhere in the tree 
+        # (e.g. by an archived user), the add alone would only see our dn. 
+        # A user at our dn with our x500UniqueIdentifier is a 
+        # half-provisioned one from an earlier run, so we resume with 
+        # the remaining (idempotent) steps.
+        resume = False
+        existing = self.getUser(l, username, ['x500UniqueIdentifier'])
+        if existing:
+            if existing[0].lower() != dn.lower() or \
+                    not sameIdentity(existing, action.x500UniqueIdentifier):
+                return userTaken(username)
+            logging.info("user {0} already exists with matching " \
+                            "x500UniqueIdentifier - resuming".format(username))
+            resume = True
+            
+        # Create new user if it does not exist
+        try:
+            if action.userType == "EMP" and not action.deptGroup:
                 logging.warning("unable to find departmental group for " \
                                     "the user {0}".format(username))
-                        
-        # Note: we are not setting Login Shell attrib 
-        # to /bin/bash as described in Linux Profile doc
-        
-        # Build a dict for the "body" of the user object
-        attrs = {}
-        attrs['objectclass'] = ['top','person','organizationalPerson',
-                                'inetOrgPerson','ndsLoginProperties',
-                                'posixAccount']
-        attrs['cn'] = username
-        attrs['userPassword'] = userPassword
-        attrs['description'] = description
-        attrs['loginDisabled'] = loginDisabled
-        attrs['givenName'] = givenName
-        attrs['fullName'] = fullName
-        attrs['sn'] = sn
-        attrs['uid'] = username
-        attrs['mail'] = username + MAILDOMAIN
-        attrs['uidNumber'] = uidNumber
-        attrs['gidNumber'] = gidNumber
-        attrs['homeDirectory'] = "/Users/" + username
-        attrs['employeeType'] = employeeType
-        attrs['employeeNumber'] = dNumber[1:]
-        attrs['telexNumber'] = dNumber
-        attrs['ou'] = ou
-        attrs['x500UniqueIdentifier'] = x500UniqueIdentifier
-        attrs['businessCategory'] = businessCategory
-        if server:
-            attrs['ndsHomeDirectory'] = "cn=" + server + SHAREOU + "#0#" \
-                                        + username
-        attrs['Language'] = "ENGLISH"
-        attrs['passwordUniqueRequired'] = "TRUE"
-        attrs['passwordRequired'] = "TRUE"
-        attrs['passwordMinimumLength'] = "5"
-        attrs['passwordAllowChange'] = "TRUE"
-        attrs['loginGraceRemaining'] = "3"
-        attrs['loginGraceLimit'] = "3"
-
-        # Convert our dict to proper syntax using modlist module
-        ldif = modlist.addModlist(attrs)
-
-        # Do the actual synchronous add to the ldapserver
-        l.add_s(dn,ldif)
-        
-        # Log user creation
-        logging.info("user added to eDir: {0} - now updating groups" \
-                        .format(username))
-        print("SUCCESS: User {0} added to eDir, now updating groups." \
-                        .format(username))
-        
-        # Add user to GeneralMacUsers groups (and DeptGroup if exists)
-        for group in groups:
-            # First update the user
-            mod_attrs = [( ldap.MOD_ADD, 'securityEquals', group ), 
-                        ( ldap.MOD_ADD, 'groupMembership', group )]
-            l.modify_s(dn, mod_attrs)
-            # and now modify the group
-            addMember(l, group, dn)
-        
-        logging.info("user {0} added to the eDir groups - now adding " \
-                        "memberUid hack".format(username))
-        
-        # Add the username to memberUid attrib of GeneralMacUsers group
-        mod_attrs = [( ldap.MOD_ADD, 'memberUid', username )]
-        l.modify_s(gdn, mod_attrs)
-        logging.info("user {0} added to memberUid attrib of eDir group {1} " \
-                        "- deprecate later!".format(username, gdn))
-        
-        # Its nice to the server to disconnect
-        l.unbind_s()
-        
-    except ldap.LDAPError, e:
-        print("ERROR: Could not add user to eDir or update groups: " \
-                    "{0}".format(e))
-        logging.error("eDir add or group update failed for user {0}: " \
-                    "{1}".format(username, e))
-        result = "ERROR: Could not create eDir user or update groups."
-        return result
-    
-    try:
-        # Make HTTP requests to create homes/quotas
-        # Exclude guest accounts from space creation
-        if userType == "STU":
-            response = urllib.urlopen(
-            "http://stufileserver.domain.edu/cgi-bin/getspace.pl?username=" 
-            + username)
-            code = response.getcode()
-            logging.info("request status for stufileserver: {0}".format(code))
 
-        elif userType == "GST":
-            logging.info("not requesting any space for the guest user: {0}" \
+            # Do the actual synchronous add to the ldapserver
+            if not resume:
+                try:
+                    l.add_s(dn, self.userAddList(action))
+                except ldap.ALREADY_EXISTS:
+                    # Either a half-provisioned user or the add 
+                    # went through before the connection dropped
+                    if not sameIdentity(self.getUser(l, username, 
+                                        ['x500UniqueIdentifier']), 
+                                        action.x500UniqueIdentifier):
+                        return userTaken(username)
+                    logging.info("user {0} was already added - resuming" \
+                                    .format(username))
+            
+            # Log user creation
+            logging.info("user added to eDir: {0} - now updating groups" \
                             .format(username))
-        else:
-            response = urllib.urlopen(
-            "http://empfileserver.domain.edu/cgi-bin/getspace.pl?username=" 
-            + username)
-            code = response.getcode()
-            logging.info("request status for empfileserver: {0}".format(code))
+            print("SUCCESS: User {0} added to eDir, now updating groups." \
+                            .format(username))
+            
+            # Add user to GeneralMacUsers groups (and DeptGroup if exists)
+            for group in action.groups:
+                # First update the user
+                mod_attrs = [( ldap.MOD_ADD, 'securityEquals', group ), 
+                            ( ldap.MOD_ADD, 'groupMembership', group )]
+                modifyStep(l, dn, mod_attrs)
+                # and now modify the group
+                addMember(l, group, dn)
+            
+            logging.info("user {0} added to the eDir groups - now adding " \
+                            "memberUid hack".format(username))
+            
+            # Add the username to memberUid attrib of GeneralMacUsers group
+            mod_attrs = [( ldap.MOD_ADD, 'memberUid', username )]
+            modifyStep(l, action.gdn, mod_attrs)
+            logging.info("user {0} added to memberUid attrib of eDir group {1} " \
+                            "- deprecate later!".format(username, action.gdn))
+            
+        except ldap.LDAPError, e:
+            print("ERROR: Could not add user to eDir or update groups: " \
+                        "{0}".format(e))
+            logging.error("eDir add or group update failed for user {0}: " \
+                        "{1}".format(username, e))
+            result = "ERROR: Could not create eDir user or update groups."
+            return result
+        
+        try:
+            # Make HTTP requests to create homes/quotas
+            # Exclude guest accounts from space creation
+            if action.userType == "GST":
+                logging.info("not requesting any space for the guest user: {0}" \
+                                .format(username))
+            else:
+                self.requestSpace(spaceURL(action.userType, username))
 
-    except Exception as e:
-            print("ERROR: unknown error while requesting user storage: {0}" \
-                    .format(e))
-            logging.error("unknown error while requesting user storage: {0}" \
-                    .format(e))
-            result = "ERROR: Could not provision storage for the user."
-    
-    print("SUCCESS: user added to eDir/groups and space was requested" \
-            .format(dn))
-    logging.info("user {0} was added to eDir/groups and space was requested" \
-            .format(dn))
-    result = "SUCCESS: User added to eDir."
-    
-    return result
+        except Exception as e:
+                print("ERROR: unknown error while requesting user storage: {0}" \
+                        .format(e))
+                logging.error("unknown error while requesting user storage: {0}" \
+                        .format(e))
+                result = "ERROR: Could not provision storage for the user."
+        
+        print("SUCCESS: user added to eDir/groups and space was requested" \
+                .format(dn))
+        logging.info("user {0} was added to eDir/groups and space was requested" \
+                .format(dn))
+        result = "SUCCESS: User added to eDir."
+        
+        return result
 
-   
-def update(username, newusername, loginDisabled, uidNumber, gidNumber, 
-            givenName, fullName, sn, employeeType, dNumber, 
-            x500UniqueIdentifier, ou, businessCategory, description):
-    """This function updates user attributes 
-    and renames users if needed"""
-    
-    # Note: on ou update, eDir departmental groups are not updated!
-    
-    # Check if any of the arguments are missing
-    params = locals()
-    
-    for _item in params:
-        if str(params[_item]) == "":
+    def update(self, action):
+        """This function updates user attributes 
+        and renames users if needed"""
+        
+        username = action.username
+        newusername = action.newusername
+        
+        # Check if any of the arguments are missing
+        _item = action.missing()
+        if _item:
             print("ERROR: unable to update user {0} because {1} is missing " \
                     "a value".format(username, _item))
             logging.error("unable to update user {0} because {1} is missing " \
@@ -380,536 +1091,2231 @@ def update(username, newusername, loginDisabled, uidNumber, gidNumber,
                         + _item + " in input file."
             return result
 
-    # We have all we need, connect to LDAP
-    l = ldapConnect()
-    
-    # Catch the condition when LDAP connection failed
-    if not l:
-        result = "ERROR: unable to connect to LDAP server."
-        return result
-    
-    # Do a quick check if the user exists
-    if not findUser(l, username):
-        print("ERROR: user does not exist: {0}".format(username))
-        logging.error("user does not exist: {0}".format(username))
-        result = "ERROR: user could not be found!"
-        return result
-    
-    # rename if new username is diferent
-    if username != newusername:
-        # First check if both usernames are in the same OU
-        userType = getUserType(username)
-        
-        if userType != getUserType(newusername):
-            print("ERROR: unable to rename user {0} to {1} because " \
-                    "they are of different type".format(username, newusername))
-            logging.error("unable to rename user {0} to {1} because " \
-                    "they are of different type".format(username, newusername))
-            result = "ERROR: can't rename users across different OUs."
+        # We have all we need, connect to LDAP
+        l = self.ldapConnect()
+        
+        # Catch the condition when LDAP connection failed
+        if not l:
+            result = "ERROR: unable to connect to LDAP server."
             return result
+        
+        # Do a quick check if the user exists, unless 
+        # we let the writes tell us (noSuchObject)
+        if not self.USECONTROLS and not self.findUser(l, username):
+            return userNotFound(username)
+        
+        # rename if new username is diferent
+        if username != newusername:
+            # First check if both usernames are in the same OU
+            if action.userType != self.getUserType(newusername):
+                print("ERROR: unable to rename user {0} to {1} because " \
+                        "they are of different type".format(username, newusername))
+                logging.error("unable to rename user {0} to {1} because " \
+                        "they are of different type".format(username, newusername))
+                result = "ERROR: can't rename users across different OUs."
+                return result
 
-        # Rename the user
-        try:
-            # Get the dn of our old user
-            dn = buildDN(username)
-            
-            # Check if the new user name already exists
-            if findUser(l, newusername):
-                print("ERROR: cannot rename user - user already exists: {0}" \
-                        .format(newusername))
-                logging.error("cannot rename user - user already exists: {0}" \
-                                .format(newusername))
-                result = "ERROR: username already taken!"
+            # Rename the user
+            try:
+                # Get the dn of our old user
+                dn = action.dn
+                
+                # Check if the new user name already exists anywhere 
+                # in the tree, the rename alone would only see our ou
+                if self.findUser(l, newusername):
+                    return userTaken(newusername, "rename")
+                
+                # you can safely ignore the results returned as an exception 
+                # will be raised if the rename doesn't work.
+                try:
+                    l.rename_s(dn, 'cn=' + newusername)
+                except ldap.ALREADY_EXISTS:
+                    return userTaken(newusername, "rename")
+                except ldap.NO_SUCH_OBJECT:
+                    # The rename went through before the connection dropped
+                    if l.retried and self.findUser(l, newusername):
+                        logging.info("user {0} was already renamed to {1} - " \
+                                        "resuming".format(username, newusername))
+                    elif self.USECONTROLS:
+                        return userNotFound(username)
+                    else:
+                        raise
+                
+                logging.info("user {0} renamed to {1} in eDir" \
+                                .format(username, newusername))
+                
+                # Update old memeberUID attribute in *GeneralMac_Users Group          
+                gn = action.gn
+                gdn = action.gdn
+                
+                # Add new username to memberUid attrib of GeneralMacUsers group
+                mod_attrs = [( ldap.MOD_ADD, 'memberUid', newusername )]
+                modifyStep(l, gdn, mod_attrs)
+                logging.info("user {0} added to memberUid attrib of eDir group " \
+                                "{1} - deprecate later!".format(newusername, gdn))
+                
+                # Find and delete the old memberUid attribute value
+                delMemberUid(l, gn, gdn, username)
+
+            except ldap.LDAPError, e:
+                print("ERROR: Could not rename user or update GeneralMac_Users " \
+                        "group in eDir: {0}".format(e))
+                logging.error("eDir rename failed from: {0} to {1} or update of " \
+                       "GeneralMac_Users group failed: {2}" \
+                       .format(username, newusername, e))
+                result = "ERROR: Could not rename eDir user."
                 return result
-            
-            # you can safely ignore the results returned as an exception 
-            # will be raised if the rename doesn't work.
-            l.rename_s(dn, 'cn=' + newusername)
-            
-            logging.info("user {0} renamed to {1} in eDir" \
+                
+            except Exception as e:
+                print("ERROR: unknown error while renaming user: {0}".format(e))
+                logging.error("unknown error while attempting to rename user: {0}" \
+                                .format(e))
+                result = "ERROR: Could not rename eDir user."
+                
+            print("INFO: user {0} renamed to {1} in eDir" \
+                    .format(username, newusername))
+            logging.info("user {0} fully renamed to {1} in eDir" \
                             .format(username, newusername))
             
-            # Update old memeberUID attribute in *GeneralMac_Users Group          
-            if userType == "STU":
-                gn = StuGeneralMacUsers
-            elif userType == "GST":
-                gn = GuestGeneralMacUsers
-            else:
-                gn = EmpGeneralMacUsers
-            
-            gdn = "cn=" + gn + GeneralMacUsersOU
+            # Send an email to the operator re: outstanding
+            # renames of home folders and eDir homeDir attribute
+            frm = self.FROM
+            to = self.TO
+            subject = "eDir user renamed: " + dn + " to " + newusername
+            text = "Need to rename home folder " \
+                    "as well as ndsHomeDirectory attribute!"
+                    
+            self.sendMail(frm, to, subject, text)
+            logging.info("emailed {0} about user folder re-naming".format(to))
+                    
+        # Rename or not, update attributes or disable
+        try:
+            # The dn of our user to update
+            dn = action.newdn
             
-            # Add new username to memberUid attrib of GeneralMacUsers group
-            mod_attrs = [( ldap.MOD_ADD, 'memberUid', newusername )]
-            l.modify_s(gdn, mod_attrs)
-            logging.info("user {0} added to memberUid attrib of eDir group " \
-                            "{1} - deprecate later!".format(newusername, gdn))
+            # Can't just replace multiple businessCategory attribute values
+            # with ( ldap.MOD_REPLACE, 'businessCategory', businessCategory )
+            # bc all the businessCategory values will be deleted and replaced
+            # with this one. First delete the exisitng
+            # Aruba-User-Role value(s), and replace with the new one.
+            # We read the user entry itself, noSuchObject if it's not there.
+            ldap_result = l.search_s(dn, ldap.SCOPE_BASE, "objectClass=*", 
+                                        ['businessCategory', 'groupMembership'])
             
-            # Find and delete the old memberUid attribute value
-            delMemberUid(l, gn, gdn, username)
+            for value in ldap_result[0][1]['businessCategory']:
+                if self.ARUBAPATTERN in value:
+                    mod_attrs = [ ( ldap.MOD_DELETE, 'businessCategory', value ) ]
+                    modifyStep(l, dn, mod_attrs)
+
+            # Do the actual modifications
+            modifyStep(l, dn, userModList(action))
 
+            # Move the user to the groups of their (new) ou/type
+            olddn = action.dn if username != newusername else None
+            self.reconcileGroups(l, action, 
+                    ldap_result[0][1].get('groupMembership', []), olddn)
+
+        except ldap.NO_SUCH_OBJECT:
+            return userNotFound(newusername)
+            
         except ldap.LDAPError, e:
-            print("ERROR: Could not rename user or update GeneralMac_Users " \
-                    "group in eDir: {0}".format(e))
-            logging.error("eDir rename failed from: {0} to {1} or update of " \
-                   "GeneralMac_Users group failed: {2}" \
-                   .format(username, newusername, e))
-            result = "ERROR: Could not rename eDir user."
+            print("ERROR: Could not update user in eDir: {0}".format(e))
+            logging.error("eDir update failed for {0}: {1}".format(username, e))
+            result = "ERROR: Could not update eDir user."
             return result
-            
+        
         except Exception as e:
-            print("ERROR: unknown error while renaming user: {0}".format(e))
-            logging.error("unknown error while attempting to rename user: {0}" \
-                            .format(e))
-            result = "ERROR: Could not rename eDir user."
-            
-        print("INFO: user {0} renamed to {1} in eDir" \
-                .format(username, newusername))
-        logging.info("user {0} fully renamed to {1} in eDir" \
-                        .format(username, newusername))
-        
-        # Send an email to the operator re: outstanding
-        # renames of home folders and eDir homeDir attribute
-        frm = FROM
-        to = TO
-        subject = "eDir user renamed: " + dn + " to " + newusername
-        text = "Need to rename home folder " \
-                "as well as ndsHomeDirectory attribute!"
+            print("ERROR: unknown error while updating user: {0}".format(e))
+            logging.error("unknown error while updating user: {0}".format(e))
+            result = "ERROR: Could not update eDir user."
                 
-        sendMail(frm, to, subject, text)
-        logging.info("emailed {0} about user folder re-naming".format(to))
-                
-    # Rename or not, update attributes or disable
-    try:
-        # The dn of our user to update
-        dn = buildDN(newusername) 
-        
-        # Can't just replace multiple businessCategory attribute values
-        # with ( ldap.MOD_REPLACE, 'businessCategory', businessCategory )
-        # bc all the businessCategory values will be deleted and replaced
-        # with this one. First delete the exisitng
-        # Aruba-User-Role value(s), and replace with the new one.
-        searchScope = ldap.SCOPE_SUBTREE
-        searchFilter = "cn=" + newusername
-        ldap_result = l.search_s(baseDN, searchScope, searchFilter, 
-                                    ['businessCategory'])
-        
-        for value in ldap_result[0][1]['businessCategory']:
-            if ARUBAPATTERN in value:
-                mod_attrs = [ ( ldap.MOD_DELETE, 'businessCategory', value ) ]
-                l.modify_s(dn, mod_attrs)
-
-        # Build the list of modifications
-        # We do not reset passwords here!
-        mod_attrs = [
-            ( ldap.MOD_REPLACE, 'description', description ),
-            ( ldap.MOD_REPLACE, 'loginDisabled', loginDisabled ),
-            ( ldap.MOD_REPLACE, 'givenName', givenName ),
-            ( ldap.MOD_REPLACE, 'fullName', fullName ),
-            ( ldap.MOD_REPLACE, 'sn', sn ),
-            ( ldap.MOD_REPLACE, 'uid', newusername ),
-            ( ldap.MOD_REPLACE, 'mail', newusername + MAILDOMAIN ),
-            ( ldap.MOD_REPLACE, 'uidNumber', uidNumber ),
-            ( ldap.MOD_REPLACE, 'gidNumber', gidNumber ),
-            ( ldap.MOD_REPLACE, 'homeDirectory', "/Users/" + newusername ),
-            ( ldap.MOD_REPLACE, 'employeeType', employeeType ),
-            ( ldap.MOD_REPLACE, 'employeeNumber', dNumber[1:] ),
-            ( ldap.MOD_REPLACE, 'telexNumber', dNumber ),
-            ( ldap.MOD_REPLACE, 'ou', ou ),
-            ( ldap.MOD_REPLACE, 'x500UniqueIdentifier', x500UniqueIdentifier ),
-            ( ldap.MOD_ADD, 'businessCategory', businessCategory )
-        ]
+        print("SUCCESS: user {0} updated in eDir".format(newusername))
+        logging.info("User {0} updated in eDir".format(dn))
+        result = "SUCCESS: User updated in eDir."
         
-        # Do the actual modifications
-        l.modify_s(dn, mod_attrs)
+        return result
 
-        # Its nice to the server to disconnect when done
-        l.unbind_s()
+    def userAddList(self, action):
+        """Function to build the "body" of a new user object"""
+
+        # Note: we are not setting Login Shell attrib 
+        # to /bin/bash as described in Linux Profile doc
+        username = action.username
+        ldif = [
+            ('objectclass', ['top','person','organizationalPerson',
+                             'inetOrgPerson','ndsLoginProperties',
+                             'posixAccount']),
+            ('cn', [username]),
+            ('userPassword', [action.userPassword]),
+            ('description', [action.description]),
+            ('loginDisabled', [action.loginDisabled]),
+            ('givenName', [action.givenName]),
+            ('fullName', [action.fullName]),
+            ('sn', [action.sn]),
+            ('uid', [username]),
+            ('mail', [action.mail]),
+            ('uidNumber', [action.uidNumber]),
+            ('gidNumber', [action.gidNumber]),
+            ('homeDirectory', [action.homeDirectory]),
+            ('employeeType', [action.employeeType]),
+            ('employeeNumber', [action.dNumber[1:]]),
+            ('telexNumber', [action.dNumber]),
+            ('ou', [action.ou]),
+            ('x500UniqueIdentifier', [action.x500UniqueIdentifier]),
+            ('businessCategory', [action.businessCategory])
+        ]
+        if action.homeServer:
+            ldif.append(('ndsHomeDirectory', ["cn=" + action.homeServer 
+                                              + self.SHAREOU + "#0#" 
+                                              + username]))
+        ldif.extend([
+            ('Language', ["ENGLISH"]),
+            ('passwordUniqueRequired', ["TRUE"]),
+            ('passwordRequired', ["TRUE"]),
+            ('passwordMinimumLength', ["5"]),
+            ('passwordAllowChange', ["TRUE"]),
+            ('loginGraceRemaining', ["3"]),
+            ('loginGraceLimit', ["3"])
+        ])
+
+        return ldif
+
+    def archive(self, action):
+        """This functions moves a
+        DISABLED user to _Archive.* OU"""
         
-    except ldap.LDAPError, e:
-        print("ERROR: Could not update user in eDir: {0}".format(e))
-        logging.error("eDir update failed for {0}: {1}".format(username, e))
-        result = "ERROR: Could not update eDir user."
-        return result
-    
-    except Exception as e:
-        print("ERROR: unknown error while updating user: {0}".format(e))
-        logging.error("unknown error while updating user: {0}".format(e))
-        result = "ERROR: Could not update eDir user."
+        username = action.username
+        
+        # Check if the argument is missing
+        if str(username) == "":
+            print("ERROR: unable to archive user because username argument " \
+                    "is missing a value")
+            logging.error("unable to archive user because username argument " \
+                            "is missing a value")
+            result = "ERROR: Missing an expected input value for username " \
+                        "in input file."
+            return result
+                
+        # We have all we need, connect to LDAP
+        l = self.ldapConnect()
+        
+        # Catch the condition when LDAP connection failed
+        if not l:
+            result = "ERROR: unable to connect to LDAP server."
+            return result
+        
+        # Does the user exist and is it disabled? With the assertion 
+        # control the move itself checks this.
+        result, serverctrls = self.disabledCheck(l, username, action.dn)
+        if result:
+            return result
             
-    print("SUCCESS: user {0} updated in eDir".format(newusername))
-    logging.info("User {0} updated in eDir".format(dn))
-    result = "SUCCESS: User updated in eDir."
-    
-    return result
-
-    
-def archive(username):
-    """This functions moves a
-    DISABLED user to _Archive.* OU"""
-    
-    # Check if the argument is missing
-    if str(username) == "":
-        print("ERROR: unable to archive user because username argument " \
-                "is missing a value")
-        logging.error("unable to archive user because username argument " \
-                        "is missing a value")
-        result = "ERROR: Missing an expected input value for username " \
-                    "in input file."
-        return result
+        # Archive the user if all is OK
+        try:
+            dn = action.dn
+            # Set the archival container for our user
+            userType = action.userType
             
-    # We have all we need, connect to LDAP
-    l = ldapConnect()
-    
-    # Catch the condition when LDAP connection failed
-    if not l:
-        result = "ERROR: unable to connect to LDAP server."
-        return result
-    
-    # Do a quick check if the user exists
-    if not findUser(l, username):
-        print("ERROR: user does not exist: {0}".format(username))
-        logging.error("user does not exist: {0}".format(username))
-        result = "ERROR: user could not be found!"
-        return result
-    
-    # Is the user disabled?
-    if not userDisabled(l, username):
-        print("ERROR: user is not disabled: {0}".format(username))
-        logging.error("user is not disabled: {0}".format(username))
-        result = "ERROR: user is not disabled!"
+            if userType == "GST":
+                result = "ERROR: we do not archive guest accounts."
+                return result
+            container_new = self.archiveOU(userType)[1:]
+                
+            try:
+                l.rename_ext_s(dn, 'cn=' + username, container_new, 
+                                serverctrls=serverctrls)
+            except ldap.ASSERTION_FAILED:
+                return userNotDisabled(username)
+            except ldap.NO_SUCH_OBJECT:
+                # The move went through before the connection dropped
+                if not l.retried:
+                    return userNotFound(username)
+                logging.info("user {0} was already archived - resuming" \
+                                .format(username))
+            
+        except ldap.LDAPError, e:
+            print("ERROR: Could move user in eDir: {0}".format(e))
+            logging.error("eDir move failed for user {0}: {1}".format(username, e))
+            result = "ERROR: Could not move eDir user."
+            return result
+            
+        print("SUCCESS: user {0} archived in eDir".format(username))
+        logging.info("user {0} archived in eDir".format(dn))
+        result = "SUCCESS: User archived in eDir."
+        
         return result
+
+    def delete(self, action):
+        """This function deletes 
+        a DISABLED user from eDir"""
         
-    # Archive the user if all is OK
-    try:
-        dn = buildDN(username)
-        # Set the archival container for our user
-        userType = getUserType(username)
+        username = action.username
         
-        if userType == "STU":
-            container_new = "ou=_Archive" + STUDENTOU
-        elif userType == "GST":
-            result = "ERROR: we do not archive guest accounts."
+        # Note that script only deletes users from Employee/Studetn/Visitor OUs
+        # It does not delete them from _Archive OUs
+        
+        # Check if the argument is missing
+        if str(username) == "":
+            print("ERROR: unable to delete user because username argument " \
+                    "is missing a value")
+            logging.error("unable to delete user because username argument " \
+                            "is missing a value")
+            result = "ERROR: Missing an expected input value for username " \
+                        "in input file."
             return result
-        else:
-            container_new = "ou=_Archive" + EMPOU
+                
+        # We have all we need, connect to LDAP
+        l = self.ldapConnect()
             
-        l.rename_s(dn, 'cn=' + username, container_new)
-        
-        # Its nice to the server to disconnect when done
-        l.unbind_s()
-        
-    except ldap.LDAPError, e:
-        print("ERROR: Could move user in eDir: {0}".format(e))
-        logging.error("eDir move failed for user {0}: {1}".format(username, e))
-        result = "ERROR: Could not move eDir user."
-        return result
+        # Catch the condition when LDAP connection failed
+        if not l:
+            result = "ERROR: unable to connect to LDAP server."
+            return result
         
-    print("SUCCESS: user {0} archived in eDir".format(username))
-    logging.info("user {0} archived in eDir".format(dn))
-    result = "SUCCESS: User archived in eDir."
-    
-    return result
+        # Does the user exist and is it disabled? With the assertion 
+        # control the delete itself checks this.
+        result, serverctrls = self.disabledCheck(l, username, action.dn)
+        if result:
+            return result
+            
+        # Delete the user if all is OK
+        try:
+            # Get the dn of our user
+            dn = action.dn
+            
+            try:
+                l.delete_ext_s(dn, serverctrls=serverctrls)
+            except ldap.ASSERTION_FAILED:
+                return userNotDisabled(username)
+            except ldap.NO_SUCH_OBJECT:
+                # The delete went through before the connection dropped
+                if not l.retried:
+                    return userNotFound(username)
+                logging.info("user {0} was already deleted - resuming" \
+                                .format(dn))
+            logging.info("user {0} deleted from eDir".format(dn))
+            
+            # Delete old memeberUid attribute from correct GeneralMac_Users Group       
+            delMemberUid(l, action.gn, action.gdn, username)
+            
+        except ldap.LDAPError, e:
+            print("ERROR: Could not delete user in eDir: {0}".format(e))
+            logging.error("eDir delete failed for {0}: {1}".format(dn, e))
+            result = "ERROR: Could not delete eDir user."
+            return result
 
-    
-def delete(username):
-    """This function deletes 
-    a DISABLED user from eDir"""
-    
-    # Note that script only deletes users from Employee/Studetn/Visitor OUs
-    # It does not delete them from _Archive OUs
-    
-    # Check if the argument is missing
-    if str(username) == "":
-        print("ERROR: unable to delete user because username argument " \
-                "is missing a value")
-        logging.error("unable to delete user because username argument " \
-                        "is missing a value")
-        result = "ERROR: Missing an expected input value for username " \
-                    "in input file."
-        return result
+        except Exception as e:
+            print("ERROR: unknown error while deleting user: {0}".format(e))
+            logging.error("unknown error while deleting user: {0}".format(e))
+            result = "ERROR: Could not delete eDir user."
             
-    # We have all we need, connect to LDAP
-    l = ldapConnect()
+        print("SUCCESS: user {0} deleted from eDir".format(username))
+        logging.info("user {0} fully deleted from eDir".format(dn))
+        result = "SUCCESS: User deleted from eDir."
         
-    # Catch the condition when LDAP connection failed
-    if not l:
-        result = "ERROR: unable to connect to LDAP server."
-        return result
-    
-    # Do a quick check if the user exists
-    if not findUser(l, username):
-        print("ERROR: user does not exist: {0}".format(username))
-        logging.error("user does not exist: {0}".format(username))
-        result = "ERROR: user could not be found!"
-        return result
-    
-    # Is the user disabled?
-    if not userDisabled(l, username):
-        print("ERROR: user is not disabled: {0}".format(username))
-        logging.error("user is not disabled: {0}".format(username))
-        result = "ERROR: user is not disabled!"
-        return result
-        
-    # Delete the user if all is OK
-    try:
-        # Get the dn of our user
-        dn = buildDN(username)
-        
-        l.delete_s(dn)
-        logging.info("user {0} deleted from eDir".format(dn))
+        # Send an email to the operator about 
+        # needing to deprov home folder
+        frm = self.FROM
+        to = self.TO
+        subject = "eDir user deleted: " + dn
+        text = "Need to deprovision home folder!"
         
-        # Delete old memeberUid attribute from correct GeneralMac_Users Group       
-        userType = getUserType(username)
+        self.sendMail(frm, to, subject, text)
+        logging.info("sent an email to {0} about user files deprovisioning" \
+                        .format(to))
         
+        return result
+
+    def sweep(self, days, purge=False):
+        """Archive the users of STUDENTOU/EMPOU that have been disabled 
+        and unchanged for days, or with purge delete such users from 
+        the _Archive containers. Candidates come from a paged search 
+        and are moved/deleted SWEEPWINDOW at a time without waiting 
+        for each. Yields (action, username, result)."""
+
+        kind = "delete" if purge else "archive"
+
+        l = self.ldapConnect()
+        if not l:
+            yield kind, "", "ERROR: unable to connect to LDAP server."
+            return
+
+        before = time.strftime("%Y%m%d%H%M%SZ", 
+                                time.gmtime(time.time() - days * 86400))
+        searchFilter = "(&(loginDisabled=TRUE)(modifyTimestamp<=" + \
+                        before + "))"
+
+        # Deleted usernames by GeneralMac_Users group, for the memberUid 
+        # cleanup (archived users keep theirs, as with archive())
+        memberUids = {}
+        deleted = []
+        # Users whose delete was in flight when the sweep gave up
+        unknown = []
+
+        # The cleanup and email also cover a sweep that fails or whose 
+        # caller stops early
+        try:
+            # Guests are not archived
+            for ou in [self.STUDENTOU, self.EMPOU]:
+                for swept in self.sweepOU(l, ou, searchFilter, before, kind, 
+                                            purge, memberUids, deleted, 
+                                            unknown):
+                    yield swept
+        finally:
+            self.sweepCleanup(l, memberUids, deleted, unknown)
+
+    def sweepOU(self, l, ou, searchFilter, before, kind, purge, memberUids, 
+                deleted, unknown):
+        """Archive or purge the users of one container for sweep()"""
+
+        archive = "ou=_Archive" + ou
+        base = archive if purge else ou[1:]
+        logging.info("sweeping {0} for users disabled since {1}" \
+                        .format(base, before))
+        # Moving entries out of the container while paging through 
+        # it would skip some, so we page through the dns first
+        candidates = [dn for dn, _attrs in pagedSearch(l, base, 
+                        ldap.SCOPE_ONELEVEL, searchFilter, ['cn'], 
+                        self.PAGESIZE)]
+        logging.info("found {0} users to {1} in {2}" \
+                        .format(len(candidates), kind, base))
+
+        candidates.reverse()
+
+        # Message id -> (username, dn, server controls) of the 
+        # moves/deletes in flight
+        pending = {}
+        # dn -> server controls of the moves/deletes sent again after 
+        # the connection dropped, which may have gone through before
+        resent = {}
+        lost = 0
+
+        while candidates or pending:
+            try:
+                while candidates and len(pending) < self.SWEEPWINDOW:
+                    dn = candidates[-1]
+                    username = dn.split(',')[0][3:]
+                    if dn.lower() in resent:
+                        serverctrls = resent[dn.lower()]
+                    else:
+                        # Users enabled again since the search are left 
+                        # alone, checked by the write itself as in 
+                        # archive()/delete()
+                        result, serverctrls = self.disabledCheck(l, 
+                                                        username, dn)
+                        if result:
+                            candidates.pop()
+                            yield kind, username, result
+                            continue
+                    if purge:
+                        msgid = l.delete_ext(dn, serverctrls=serverctrls)
+                    else:
+                        msgid = l.rename(dn, 'cn=' + username, archive, 
+                                            serverctrls=serverctrls)
+                    candidates.pop()
+                    pending[msgid] = (username, dn, serverctrls)
+                result = self.sweepResult(l, pending, kind, memberUids, 
+                                            deleted, resent)
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, 
+                    ldap.TIMEOUT), e:
+                lost += 1
+                if not pending or lost > self.RECONNECTS:
+                    # Those may have gone through before the connection 
+                    # went for good
+                    for msgid in sorted(pending):
+                        username = pending.pop(msgid)[0]
+                        print("ERROR: outcome of {0} of user {1} " \
+                                "unknown: {2}".format(kind, username, e))
+                        logging.error("lost LDAP connection with eDir " \
+                                        "sweep {0} of user {1} in flight: " \
+                                        "{2}".format(kind, username, e))
+                        if kind == "delete":
+                            unknown.append(username)
+                        yield kind, username, "ERROR: outcome unknown, " \
+                                                "lost LDAP connection."
+                    raise e
+                # The results of the window went with the connection, 
+                # its moves/deletes go out again on a new one
+                logging.warning("lost LDAP connection with {0} users " \
+                                "to {1} in flight ({2}), sending them " \
+                                "again".format(len(pending), kind, e))
+                for msgid in sorted(pending, reverse=True):
+                    _username, dn, serverctrls = pending[msgid]
+                    candidates.append(dn)
+                    resent[dn.lower()] = serverctrls
+                pending = {}
+                continue
+            lost = 0
+            yield result
+
+    def sweepCleanup(self, l, memberUids, deleted, unknown):
+        """One memberUid cleanup per group and one email about the 
+        home folders to deprovision for the users sweep() deleted"""
+
+        for gdn, usernames in memberUids.items():
+            try:
+                modifyStep(l, gdn, [( ldap.MOD_DELETE, 'memberUid', uid ) 
+                                    for uid in usernames])
+                logging.info("deleted {0} memberUid values from group {1}" \
+                                .format(len(usernames), gdn))
+            except ldap.LDAPError, e:
+                print("ERROR: cannot delete memberUids from group {0}, " \
+                        "error: {1}".format(gdn, e))
+                logging.error("problem removing memberUids from group " \
+                                "{0}: {1}".format(gdn, e))
+
+        if deleted or unknown:
+            # All on one line, the message template is dedented
+            text = []
+            if deleted:
+                text.append("Need to deprovision home folders of: " + 
+                            ", ".join(deleted))
+            if unknown:
+                text.append("May have been deleted, check in eDir: " + 
+                            ", ".join(unknown))
+            text = ". ".join(text)
+            self.sendMail(self.FROM, self.TO, "eDir users deleted: {0}" \
+                            .format(len(deleted)), text)
+            logging.info("sent an email to {0} about user files " \
+                            "deprovisioning".format(self.TO))
+
+    def sweepResult(self, l, pending, kind, memberUids, deleted, resent):
+        """Wait for the oldest move/delete of a sweep 
+        and return its (action, username, result)"""
+
+        msgid = min(pending)
+        username, dn, _serverctrls = pending[msgid]
+        error = None
+        try:
+            l.result(msgid)
+        except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT):
+            # The whole window is lost, sweep() sends it again
+            raise
+        except ldap.ASSERTION_FAILED:
+            del pending[msgid]
+            return kind, username, userNotDisabled(username)
+        except ldap.LDAPError, e:
+            error = e
+        del pending[msgid]
+
+        # A move/delete sent again may have gone through the first time
+        if isinstance(error, ldap.NO_SUCH_OBJECT) and dn.lower() in resent:
+            logging.info("user {0} was already {1}d - resuming" \
+                            .format(username, kind))
+        elif error:
+            print("ERROR: Could not {0} user {1} in eDir: {2}" \
+                    .format(kind, username, error))
+            logging.error("eDir sweep {0} failed for user {1}: {2}" \
+                            .format(kind, username, error))
+            return kind, username, "ERROR: Could not " + kind + " eDir user."
+
+        if kind == "delete":
+            gdn = self.generalMacGroup(self.getUserType(username))[1]
+            memberUids.setdefault(gdn, []).append(username)
+            deleted.append(username)
+            self.moveIds(dn)
+            logging.info("user {0} deleted from eDir".format(username))
+            return kind, username, "SUCCESS: User deleted from eDir."
+
+        self.moveIds(dn, "cn=" + username + 
+                        self.archiveOU(self.getUserType(username)))
+        logging.info("user {0} archived in eDir".format(username))
+        return kind, username, "SUCCESS: User archived in eDir."
+
+    def getUserType(self, username):
+        """ Function to determine the type of a user"""
+
+        if self.STUPATTERN in username:
+            userType = "STU"
+        elif self.GSTPATTERN == username[0:-4]:
+            userType = "GST"
+        else:
+            userType = "EMP"
+
+        return userType
+
+    def generalMacGroup(self, userType):
+        """Function to find the GeneralMac_Users group 
+        (name and dn) for a type of user"""
+
         if userType == "STU":
-            gn = StuGeneralMacUsers
+            gn = self.StuGeneralMacUsers
         elif userType == "GST":
-            gn = GuestGeneralMacUsers
+            gn = self.GuestGeneralMacUsers
         else:
-            gn = EmpGeneralMacUsers
+            gn = self.EmpGeneralMacUsers
 
-        gdn = "cn=" + gn + GeneralMacUsersOU
+        return gn, "cn=" + gn + self.GeneralMacUsersOU
 
-        # Find and delete the old memberUid attribute value
-        delMemberUid(l, gn, gdn, username)
+    def lookupGroup(self, ou):
+        """ This function looks up 
+        group based on HR-provided ou"""
         
-        # Its nice to the server to disconnect when done
-        l.unbind_s()
+        # Lookup the dept group by ou
+        depGroup = DEPTGROUPS.get(ou, None)
         
-    except ldap.LDAPError, e:
-        print("ERROR: Could not delete user in eDir: {0}".format(e))
-        logging.error("eDir delete failed for {0}: {1}".format(dn, e))
-        result = "ERROR: Could not delete eDir user."
-        return result
+        if depGroup:
+            depGroup = 'cn=' + depGroup + self.DEPGROUPOU
 
-    except Exception as e:
-        print("ERROR: unknown error while deleting user: {0}".format(e))
-        logging.error("unknown error while deleting user: {0}".format(e))
-        result = "ERROR: Could not delete eDir user."
-        
-    print("SUCCESS: user {0} deleted from eDir".format(username))
-    logging.info("user {0} fully deleted from eDir".format(dn))
-    result = "SUCCESS: User deleted from eDir."
-    
-    # Send an email to the operator about 
-    # needing to deprov home folder
-    frm = FROM
-    to = TO
-    subject = "eDir user deleted: " + dn
-    text = "Need to deprovision home folder!"
-    
-    sendMail(frm, to, subject, text)
-    logging.info("sent an email to {0} about user files deprovisioning" \
-                    .format(to))
-    
-    return result
+        return depGroup
 
-    
-def readConfig(config_file):
-    """Function to import the config file"""
-    
-    if config_file[-3:] == ".py":
-        config_file = config_file[:-3]
-    settings = __import__(config_file, globals(), locals(), [])
-    
-    # Read settings and set globals
-    try: 
-        global LDAPSERVER
-        global USER
-        global PASSWORD
-        global baseDN
-        global MAILDOMAIN
-        global STUPATTERN
-        global GSTPATTERN
-        global ARUBAPATTERN
-        global STUSERVER
-        global EMPSERVER
-        global SHAREOU
-        global STUDENTOU
-        global GUESTOU
-        global EMPOU
-        global DEPGROUPOU
-        global GeneralMacUsersOU
-        global StuGeneralMacUsers
-        global GuestGeneralMacUsers
-        global EmpGeneralMacUsers
-        global EmpGeneralWSUsers
-        global FROM
-        global TO
-        global MAILSERVER
-        
-        LDAPSERVER = settings.LDAPSERVER
-        USER = settings.USER
-        PASSWORD = base64.b64decode(settings.PASSWORD)
-        baseDN = settings.BASEDN
-        MAILDOMAIN = settings.MAILDOMAIN
-        STUPATTERN = settings.STUPATTERN
-        GSTPATTERN = settings.GSTPATTERN
-        ARUBAPATTERN = settings.ARUBAPATTERN
-        STUSERVER = settings.STUSERVER
-        EMPSERVER = settings.EMPSERVER
-        SHAREOU = settings.SHAREOU
-        STUDENTOU = settings.STUDENTOU
-        GUESTOU = settings.GUESTOU
-        EMPOU = settings.EMPOU
-        DEPGROUPOU = settings.DEPGROUPOU
-        GeneralMacUsersOU = settings.GeneralMacUsersOU
-        StuGeneralMacUsers = settings.StuGeneralMacUsers
-        GuestGeneralMacUsers = settings.GuestGeneralMacUsers
-        EmpGeneralMacUsers = settings.EmpGeneralMacUsers
-        EmpGeneralWSUsers = settings.EmpGeneralWSUsers
-        FROM = settings.FROM
-        TO = settings.TO
-        MAILSERVER = settings.MAILSERVER
+    def archiveOU(self, userType):
+        """Function to find the _Archive OU for a 
+        type of user, e.g. ,ou=_Archive,ou=Employees,o=DA"""
 
-    except Exception as e:
-        logging.error("unable to parse settings file: {0}".format(e))
-        print("ERROR: unable to parse the settings file: {0}".format(e))
-        return False
+        if userType == "STU":
+            return ",ou=_Archive" + self.STUDENTOU
+
+        return ",ou=_Archive" + self.EMPOU
+
+    def managedGroups(self):
+        """Groups (lowercase dns) our rules put users in, the 
+        only ones group reconciliation adds to or removes from"""
+
+        groups = [self.generalMacGroup(userType)[1] 
+                    for userType in ("STU", "GST", "EMP")]
+        groups.append("cn=" + self.EmpGeneralWSUsers + self.GeneralMacUsersOU)
+        groups.extend('cn=' + group + self.DEPGROUPOU 
+                        for group in DEPTGROUPS.values())
+
+        return set(group.lower() for group in groups)
+
+    def reconcileGroups(self, l, action, current, olddn=None):
+        """Bring the managed groups of a user in line with the ones 
+        our rules give them (e.g. after an ou change), applying only 
+        the difference. After a rename (from olddn) the member values 
+        of the groups are checked as well."""
+
+        dn = action.newdn
+        managed = self.managedGroups()
+        desired = dict((group.lower(), group) for group in action.groups)
+        current = dict((group.lower(), group) for group in current)
+        olddns = [old for old in [olddn] if old]
+
+        for key, gdn in desired.items():
+            if key not in current:
+                mod_attrs = [( ldap.MOD_ADD, 'securityEquals', gdn ), 
+                            ( ldap.MOD_ADD, 'groupMembership', gdn )]
+                modifyStep(l, dn, mod_attrs)
+                addMember(l, gdn, dn)
+                logging.info("user {0} joins group {1}".format(dn, gdn))
+            elif olddns and not isMember(l, gdn, dn):
+                # eDir moves the member values along with the 
+                # user, so this only repairs a missing one
+                addMember(l, gdn, dn)
+            for old in olddns:
+                if isMember(l, gdn, old):
+                    delMember(l, gdn, old)
+
+        for key, gdn in current.items():
+            if key in desired or key not in managed:
+                continue
+            mod_attrs = [( ldap.MOD_DELETE, 'securityEquals', gdn ), 
+                        ( ldap.MOD_DELETE, 'groupMembership', gdn )]
+            modifyStep(l, dn, mod_attrs)
+            delMember(l, gdn, dn)
+            for old in olddns:
+                if isMember(l, gdn, old):
+                    delMember(l, gdn, old)
+            logging.info("user {0} leaves group {1}".format(dn, gdn))
+
+    def buildDN(self, username):
+        """Function to construct FQN for a username"""
+
+        # First check if emp or student or guest
+        userType = self.getUserType(username)
         
-    return True
+        if userType == "STU":
+            dn = "cn=" + username + self.STUDENTOU
+            logging.info("looks like we have a student here: {0}".format(username))
+        elif userType == "GST":
+            dn = "cn=" + username + self.GUESTOU
+            logging.info("looks like we have a guest here: {0}".format(username))
+        else:
+            dn="cn=" + username + self.EMPOU
+            logging.info("looks like we have an employee here: {0}".format(username))
 
-    
-def getUserType(username):
-    """ Function to determine the type of a user"""
+        return dn
 
-    if STUPATTERN in username:
-        userType = "STU"
-    elif GSTPATTERN == username[0:-4]:
-        userType = "GST"
-    else:
-        userType = "EMP"
+    def ldapConnect(self):
+        """Function to bind to LDAP server, all user 
+        actions share one connection"""
 
-    return userType
+        if self.connection:
+            return self.connection
 
+        try:
+            # Open a connection to the LDAP server that 
+            # rebinds by itself if the connection drops
+            if self.planner and self.planner.offline:
+                l = None
+            else:
+                l = self.bind()
+        
+        except ldap.LDAPError, e:
+            print("ERROR: Establishing LDAP connection failed: {0}".format(e))
+            logging.error("problem binding to eDir LDAP server: {0}".format(e))
+            return False
+        
+        # In --record mode all operations that reach the server are traced
+        if self.recorder and l:
+            l = RecordingLDAP(l, self.recorder)
+        
+        # In --plan/--ldif mode reads go to the server, writes are only recorded
+        if self.planner:
+            self.planner.record('bind', self.LDAPSERVER)
+            l = PlanLDAP(l, self.planner)
+        
+        self.connection = l
+        return l
 
-def lookupGroup(ou):
-    """ This function looks up 
-    group based on HR-provided ou"""
-    
-    # Create primOU->department group translation dictionary
-    deptGroups = {}
-    deptGroups['Admissions'] = 'Admissions'
-    deptGroups['Art'] = 'Art'
-    deptGroups['History'] = 'History'
-    deptGroups['Biology'] = 'Biology'
-    deptGroups['Chemistry'] = 'Chemistry'
-    deptGroups['Cinema'] = 'Cinema'
-    deptGroups['Classical Studies'] = 'Classics'
-    deptGroups['English'] = 'English'
-    deptGroups['Library'] = 'Library'
-    deptGroups['Museum'] = 'Museum'
-    deptGroups['Music'] = 'Music'
-    deptGroups['Philosophy'] = 'Philosophy'
-    deptGroups['Religion'] = 'Religion'
-    deptGroups['Theatre'] = 'Theatre'
-
-    # Lookup the dept group by ou
-    depGroup = deptGroups.get(ou, None)
-    
-    if depGroup:
-        depGroup = 'cn=' + depGroup + DEPGROUPOU
+    def findUser(self, l, username):
+        """Do a quick check if the user already exists"""
+        
+        # Set the basic search parameters
+        searchScope = ldap.SCOPE_SUBTREE
+        retrieveAttributes = None 
+        searchFilter = "cn=" + username
+            
+        try:
+            ldap_result = l.search_s(self.baseDN, searchScope, searchFilter, 
+                                        ['dn'])
+        
+        except ldap.LDAPError, e:
+            print("ERROR: problems with LDAP search: {0}".format(e))
+            logging.error("problem with LDAP search for {0}: {1}".format(username,e))
+        
+        # Check the search results
+        if len(ldap_result) == 0:
+            logging.info("user {0} does not exist in eDir".format(username))
+            return False
+            
+        return True
 
-    return depGroup
+    def getUser(self, l, username, attributes):
+        """Function to fetch the dn and 
+        selected attributes of a user"""
 
+        searchScope = ldap.SCOPE_SUBTREE
+        searchFilter = "cn=" + username
 
-def ldapConnect():
-    """Function to bind to LDAP server"""
+        ldap_result = l.search_s(self.baseDN, searchScope, searchFilter, 
+                                    attributes)
 
-    ldap_user = USER
-    ldap_secret = PASSWORD
-    ldap_server = LDAPSERVER
-    
-    try:
-        # Open a connection to the LDAP server
-        l = ldap.initialize(ldap_server)
-        l.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
+        if len(ldap_result) == 0:
+            return None
+
+        return ldap_result[0]
+
+    def userDisabled(self, l, username):
+        """Do a quick check if the user is disabled"""
         
-        # Bind with a user that has rights to add/update objects
-        l.simple_bind_s(ldap_user, ldap_secret)
-    
-    except ldap.LDAPError, e:
-        print("ERROR: Establishing LDAP connection failed: {0}".format(e))
-        logging.error("problem binding to eDir LDAP server: {0}".format(e))
-        return False
+        # Set the search arguments
+        searchScope = ldap.SCOPE_SUBTREE
+        searchFilter = "cn=" + username
+        
+        try:
+            ldap_result = l.search_s(self.baseDN, searchScope, searchFilter, 
+                                        ['loginDisabled'])
+            
+        except ldap.LDAPError, e:
+            print("ERROR: unable to retrieve loginDisabled status: " \
+                    "{0}".format(e))
+            logging.error("problem retrieving loginDisabled status for {0}: {1}" \
+                            .format(username, e))
         
-    return l
+        # Is the user disabled?
+        if ldap_result[0][1]['loginDisabled'][0] == 'TRUE':
+            return True
 
+        return False
 
-def findUser(l, username):
-    """Do a quick check if the user already exists"""
-    
-    # Set the basic search parameters
-    searchScope = ldap.SCOPE_SUBTREE
-    retrieveAttributes = None 
-    searchFilter = "cn=" + username
+    def disabledCheck(self, l, username, dn):
+        """Check that a user exists and is disabled before it is moved 
+        or deleted. Returns an error result (or None) and the server 
+        controls for the write, which carry the check if supported."""
+
+        if self.USECONTROLS and self.assertionSupported(l):
+            # The write will fail with assertionFailed if not disabled
+            return None, [assertionControl('loginDisabled', 'TRUE')]
+
+        if self.USECONTROLS:
+            # One compare on the user entry instead of two subtree searches
+            try:
+                disabled = l.compare_s(dn, 'loginDisabled', 'TRUE')
+            except ldap.NO_SUCH_OBJECT:
+                return userNotFound(username), None
+        else:
+            if not self.findUser(l, username):
+                return userNotFound(username), None
+            disabled = self.userDisabled(l, username)
+
+        if not disabled:
+            return userNotDisabled(username), None
+
+        return None, None
+
+    def assertionSupported(self, l):
+        """Check the root DSE once per CACHETIME for LDAP Assertion 
+        control support"""
+
+        # Planned writes never reach the server
+        if isinstance(l, PlanLDAP):
+            return False
+
+        if self.supportedControls is None:
+            try:
+                ldap_result = l.search_s('', ldap.SCOPE_BASE, "objectClass=*", 
+                                            ['supportedControl'])
+                self.supportedControls = ldap_result[0][1].get(
+                                            'supportedControl', [])
+            except ldap.LDAPError, e:
+                logging.warning("unable to read supported controls from the " \
+                                "root DSE: {0}".format(e))
+                self.supportedControls = []
+            self.controlsLoaded = time.time()
+            logging.info("LDAP assertion control supported: {0}" \
+                            .format(ASSERTIONCONTROL in self.supportedControls))
+
+        return ASSERTIONCONTROL in self.supportedControls
+
+    def requestSpace(self, url):
+        """Function to make the HTTP request for user space"""
+
+        # In --plan/--ldif mode we only record the request
+        if self.planner:
+            self.planner.request('http', url)
+            return
+
+        response = urllib2.urlopen(url, timeout=self.HTTPTIMEOUT)
+        code = response.getcode()
+        logging.info("request status for {0}: {1}".format(url, code))
+
+        return code
+
+    def sendMail(self, frm, to, subject, text):
+        """Function to send a notification email"""
         
-    try:
-        ldap_result = l.search_s(baseDN, searchScope, searchFilter, ['dn'])		
-    
-    except ldap.LDAPError, e:
-        print("ERROR: problems with LDAP search: {0}".format(e))
-        logging.error("problem with LDAP search for {0}: {1}".format(username,e))
-    
-    # Check the search results
-    if len(ldap_result) == 0:
-        logging.info("user {0} does not exist in eDir".format(username))
-        return False
+        # In --plan/--ldif mode we only record the email
+        if self.planner:
+            self.planner.request('smtp', to, subject, text)
+            return
+        
+        # Build the message body
+        message = textwrap.dedent("""\
+            From: {0}
+            To: {1}
+            Subject: {2}
+            {3}
+            """.format(frm, to, subject, text))
+        
+        try:
+            # Send the mail
+            mailserver = self.MAILSERVER
+            server = smtplib.SMTP(mailserver, timeout=self.NETWORKTIMEOUT)
+            server.sendmail(frm, to, message)
+            server.quit()
+            
+        except Exception as e:
+            print("ERROR: unable to send email: {0}".format(e))
+            logging.error("unknown error while sending email: {0}".format(e))
         
-    return True
+        return
+
+
+class UserAction(object):
+    """One row of the input file, parsed and normalized once, 
+    with the values derived from it precomputed"""
+
+    __slots__ = ['action', 'username', 'newusername', 'loginDisabled', 
+                 'uidNumber', 'gidNumber', 'givenName', 'fullName', 'sn', 
+                 'employeeType', 'dNumber', 'x500UniqueIdentifier', 'ou', 
+                 'businessCategory', 'userPassword', 'description', 
+                 'userType', 'dn', 'newdn', 'mail', 'homeDirectory', 
+                 'homeServer', 'groups', 'deptGroup', 'gn', 'gdn']
+
+    # Attribute names and the input file fields they come from
+    FIELDS = [('username', 'username'), ('newusername', 'newusername'), 
+              ('loginDisabled', 'loginDisabled'), ('uidNumber', 'uidNumber'), 
+              ('gidNumber', 'gidNumber'), ('givenName', 'givenName'), 
+              ('fullName', 'fullName'), ('sn', 'sn'), 
+              ('employeeType', 'employeeType'), ('dNumber', 'DNumber'), 
+              ('x500UniqueIdentifier', 'x500UniqueIdentifier'), 
+              ('ou', 'primO'), ('businessCategory', 'businessCategory'), 
+              ('userPassword', 'userPassword'), ('description', 'description')]
+
+    # Values each action can't do without
+    REQUIRED = {
+        'create': ('username', 'loginDisabled', 'uidNumber', 'gidNumber', 
+                   'givenName', 'fullName', 'sn', 'employeeType', 'dNumber', 
+                   'x500UniqueIdentifier', 'ou', 'businessCategory', 
+                   'userPassword', 'description'),
+        'update': ('username', 'newusername', 'loginDisabled', 'uidNumber', 
+                   'gidNumber', 'givenName', 'fullName', 'sn', 'employeeType', 
+                   'dNumber', 'x500UniqueIdentifier', 'ou', 
+                   'businessCategory', 'description'),
+        'archive': ('username',),
+        'delete': ('username',)
+    }
+
+    def missing(self):
+        """Name of the first required value that is empty, if any"""
+
+        for name in self.REQUIRED.get(self.action, ()):
+            if getattr(self, name) == "":
+                return name
+
+        return None
+
+
+def text(value):
+    """Function to turn an input value into a string, 
+    non-ASCII text (e.g. accented names) as UTF-8 for LDAP"""
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(value)
+
+
+def classify(action):
+    """Function to find the urgency class of a user action"""
+
+    if action.action == 'delete' or (action.action == 'update' and 
+                                      action.loginDisabled.upper() == 'TRUE'):
+        return 'disable'
+    elif action.action == 'update' and action.username != action.newusername:
+        return 'rename'
+    elif action.action in ('create', 'archive'):
+        return action.action
+
+    return 'update'
+
+
+class Scheduler(object):
+    """Hands out the indexes of user actions, most urgent class first 
+    (see PRIORITIES/DEADLINES in settings), keeping the input order 
+    of the actions of each user"""
+
+    def __init__(self, actions, priorities, deadlines):
+        self.priorities = priorities
+        self.deadlines = deadlines
+        self.start = time.time()
+        # Ready actions by urgency class, as heaps of input indexes
+        self.ready = {}
+        # Number of earlier actions of the same users still to run
+        self.waiting = {}
+        self.dependents = {}
+        self.overdue = set()
+        self.remaining = len(actions)
+
+        last = {}
+        for index, action in enumerate(actions):
+            self.dependents[index] = []
+            waiting = 0
+            for user in set([action.username, action.newusername]):
+                if user in last:
+                    self.dependents[last[user]].append(index)
+                    waiting += 1
+                last[user] = index
+            self.waiting[index] = waiting
+            if not waiting:
+                self.push(index, classify(action))
+
+        self.actions = actions
+
+    def push(self, index, urgency):
+        heapq.heappush(self.ready.setdefault(urgency, []), index)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Index of the next action to run"""
+
+        if not self.remaining:
+            raise StopIteration
+
+        elapsed = time.time() - self.start
+        best = None
+        for urgency, ready in self.ready.items():
+            if not ready:
+                continue
+            deadline = self.deadlines.get(urgency)
+            late = deadline is not None and elapsed > deadline
+            if late and urgency not in self.overdue:
+                self.overdue.add(urgency)
+                logging.warning("{0} actions missed their deadline of {1}s " \
+                                "- running them first".format(urgency, 
+                                                              deadline))
+            # Overdue classes go first, then by priority and input order
+            key = (not late, self.priorities.get(urgency, 
+                                                  len(self.priorities)), 
+                    ready[0])
+            if best is None or key < best[0]:
+                best = (key, urgency)
+
+        self.remaining -= 1
+        return heapq.heappop(self.ready[best[1]])
+
+    def last(self, index):
+        """Check that no later action shares a user with this one"""
+
+        return not self.dependents[index]
+
+    def done(self, index):
+        """Let the next actions of the same users run"""
+
+        for dependent in self.dependents.pop(index):
+            self.waiting[dependent] -= 1
+            if not self.waiting[dependent]:
+                self.push(dependent, classify(self.actions[dependent]))
+
+
+def userModList(action):
+    """Function to build the list of modifications of a user update"""
+
+    # We do not reset passwords here!
+    mod_attrs = [
+        ( ldap.MOD_REPLACE, 'description', action.description ),
+        ( ldap.MOD_REPLACE, 'loginDisabled', action.loginDisabled ),
+        ( ldap.MOD_REPLACE, 'givenName', action.givenName ),
+        ( ldap.MOD_REPLACE, 'fullName', action.fullName ),
+        ( ldap.MOD_REPLACE, 'sn', action.sn ),
+        ( ldap.MOD_REPLACE, 'uid', action.newusername ),
+        ( ldap.MOD_REPLACE, 'mail', action.mail ),
+        ( ldap.MOD_REPLACE, 'uidNumber', action.uidNumber ),
+        ( ldap.MOD_REPLACE, 'gidNumber', action.gidNumber ),
+        ( ldap.MOD_REPLACE, 'homeDirectory', action.homeDirectory ),
+        ( ldap.MOD_REPLACE, 'employeeType', action.employeeType ),
+        ( ldap.MOD_REPLACE, 'employeeNumber', action.dNumber[1:] ),
+        ( ldap.MOD_REPLACE, 'telexNumber', action.dNumber ),
+        ( ldap.MOD_REPLACE, 'ou', action.ou ),
+        ( ldap.MOD_REPLACE, 'x500UniqueIdentifier', 
+            action.x500UniqueIdentifier ),
+        ( ldap.MOD_ADD, 'businessCategory', action.businessCategory )
+    ]
+
+    return mod_attrs
+
+
+class Spool(object):
+    """Shared directory through which several edir.py workers, on one 
+    or more hosts, split an input file into partitions, claim them 
+    with leases and merge their results"""
+
+    def __init__(self, path, partitions, lease_time, poll):
+        self.path = path
+        self.partitions = partitions
+        self.lease_time = lease_time
+        self.poll = poll
+        # Written into our lease files so we can tell them from others'
+        self.owner = "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), 
+                                            int(time.time() * 1000))
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Another worker just created it
+                if not os.path.isdir(path):
+                    raise
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def partFile(self, part, suffix):
+        return self.file("part-{0:03d}{1}".format(part, suffix))
+
+    def claim(self, lease):
+        """Create a lease file, or take over one that has not been 
+        renewed for lease_time. True if the lease is now ours."""
 
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                if time.time() - os.path.getmtime(lease) < self.lease_time:
+                    return False
+                # Only one worker can move the expired lease aside
+                stale = lease + "." + self.owner
+                os.rename(lease, stale)
+            except OSError:
+                return False
+            # It may have been renewed (or replaced) since we looked
+            if time.time() - os.path.getmtime(stale) < self.lease_time:
+                try:
+                    os.link(stale, lease)
+                except OSError:
+                    pass
+                os.remove(stale)
+                return False
+            logging.warning("taking over expired lease {0} from {1}" \
+                            .format(lease, open(stale).read()))
+            os.remove(stale)
+            try:
+                fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                return False
+        os.write(fd, self.owner)
+        os.close(fd)
+        return True
 
-def userDisabled(l, username):
-    """Do a quick check if the user is disabled"""
-    
-    # Set the search arguments
-    searchScope = ldap.SCOPE_SUBTREE
-    searchFilter = "cn=" + username
-    
-    try:
-        ldap_result = l.search_s(baseDN, searchScope, searchFilter, 
-                                    ['loginDisabled'])
-        
-    except ldap.LDAPError, e:
-        print("ERROR: unable to retrieve loginDisabled status: " \
-                "{0}".format(e))
-        logging.error("problem retrieving loginDisabled status for {0}: {1}" \
-                        .format(username, e))
-    
-    # Is the user disabled?
-    if ldap_result[0][1]['loginDisabled'][0] == 'TRUE':
+    def renew(self, lease):
+        """Keep a lease alive. False if another worker took it over."""
+
+        try:
+            if open(lease).read() != self.owner:
+                return False
+            os.utime(lease, None)
+        except (IOError, OSError):
+            return False
         return True
 
-    return False
+    def release(self, lease):
+        if self.renew(lease):
+            os.remove(lease)
+
+    def split(self, in_file, provisioner):
+        """Split the input into partitions by user, unless 
+        another worker did it already (manifest.json exists)"""
+
+        manifest = self.file("manifest.json")
+        lease = self.file("split.lease")
+        while not os.path.exists(manifest):
+            if not self.claim(lease):
+                time.sleep(self.poll)
+                continue
+
+            rows = json.load(open(in_file, 'rb'))["useractions"]
+            parts = [[] for _i in range(self.partitions)]
+            keys = partitionKeys(rows)
+            done = []
+
+            # uidNumber/gidNumber conflicts are only visible batch-wide, 
+            # so they are checked (and answered) before the split
+            conflicts = {}
+            if provisioner.IDCHECK:
+                conflicts = provisioner.checkIds(
+                                [provisioner.parseAction(row) for row in rows])
+
+            for index, row in enumerate(rows):
+                if index in conflicts:
+                    done.append([index, text(row.get("action", "")), 
+                                text(row.get("username", "")), 
+                                conflicts[index]])
+                    continue
+                part = (zlib.crc32(keys[index].encode('utf-8')) & 0xffffffff) \
+                        % self.partitions
+                parts[part].append([index, row])
+
+            for part, partRows in enumerate(parts):
+                if partRows:
+                    json.dump(partRows, open(self.partFile(part, ".json"), 
+                                            'wb'))
+                else:
+                    self.finish(part, [])
+            self.finish(None, done)
+
+            # The manifest appears atomically, once the partitions exist
+            json.dump({"input": in_file, "rows": len(rows), 
+                        "partitions": self.partitions}, 
+                        open(manifest + ".tmp", 'wb'))
+            os.rename(manifest + ".tmp", manifest)
+            logging.info("split {0} rows of {1} into {2} partitions" \
+                            .format(len(rows), in_file, self.partitions))
+            self.release(lease)
+
+        # Workers of one run must agree on the partition count
+        self.partitions = json.load(open(manifest, 'rb'))["partitions"]
+
+    def finish(self, part, results):
+        """Write the final results of a partition 
+        (or of the split, if part is None)"""
+
+        name = self.file("split.csv") if part is None \
+                else self.partFile(part, ".csv")
+        f = open(name + ".tmp", 'wb')
+        csv.writer(f).writerows(results)
+        f.close()
+        os.rename(name + ".tmp", name)
+
+    def work(self, provisioner, deadline=None):
+        """Run partitions until all of them are done, 
+        waiting on (and taking over) other workers' leases"""
+
+        if deadline is not None:
+            deadline = time.time() + deadline
+
+        while True:
+            pending = [part for part in range(self.partitions) 
+                        if not os.path.exists(self.partFile(part, ".csv"))]
+            if not pending:
+                return
+
+            ran = False
+            for part in pending:
+                lease = self.partFile(part, ".lease")
+                if os.path.exists(self.partFile(part, ".csv")) or \
+                    not self.claim(lease):
+                    continue
+                ran = True
+                remaining = None
+                if deadline is not None:
+                    remaining = max(0, deadline - time.time())
+                self.runPartition(provisioner, part, lease, remaining)
+
+            if not ran:
+                time.sleep(self.poll)
+
+    def runPartition(self, provisioner, part, lease, deadline):
+        """Run the rows of a partition we hold the lease of, 
+        skipping the ones a crashed worker already finished"""
+
+        rows = json.load(open(self.partFile(part, ".json"), 'rb'))
+
+        # Keep complete result rows of earlier attempts. Each worker 
+        # writes its own partial file, a worker whose lease we took 
+        # over may still be appending to its one. Rows end in a "." 
+        # column, one cut short by a crash does not and runs again 
+        # (the steps are idempotent).
+        prefix = os.path.basename(self.partFile(part, ".partial."))
+        partials = [self.file(name) for name 
+                    in sorted(os.listdir(self.path)) if name.startswith(prefix)]
+        results = []
+        finished = set()
+        for name in partials:
+            try:
+                for r in csv.reader(open(name, 'rb')):
+                    if len(r) == 5 and r[4] == "." and \
+                            int(r[0]) not in finished:
+                        results.append(r[:4])
+                        finished.add(int(r[0]))
+            except csv.Error, e:
+                # e.g. cut off inside a quoted value
+                logging.warning("partial results file {0} ends in an " \
+                                "incomplete row: {1}".format(name, e))
+        partial = self.partFile(part, ".partial." + 
+                                self.owner.replace(":", "."))
+        partials.append(partial)
+        f = open(partial, 'wb')
+        writer = csv.writer(f)
+
+        todo = [(index, row) for index, row in rows if index not in finished]
+        logging.info("running partition {0}: {1} rows, {2} done before" \
+                        .format(part, len(todo), len(finished)))
+
+        for i, action, result in provisioner.apply([row for _index, row 
+                                                    in todo], deadline):
+            result_row = [todo[i][0], action.action, action.username, result]
+            writer.writerow(result_row + ["."])
+            f.flush()
+            results.append(result_row)
+            if not self.renew(lease):
+                logging.warning("lost the lease of partition {0}, leaving " \
+                                "it to its new owner".format(part))
+                f.close()
+                return
+        f.close()
+
+        self.finish(part, results)
+        for name in partials:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        self.release(lease)
+
+    def merge(self, out_file):
+        """Write the results of all partitions 
+        to out_file, in input order"""
+
+        results = []
+        for name in ["split.csv"] + ["part-{0:03d}.csv".format(part) 
+                                        for part in range(self.partitions)]:
+            results.extend(csv.reader(open(self.file(name), 'rb')))
+        results.sort(key=lambda r: int(r[0]))
+
+        # Every worker merges, each through its own temporary file
+        tmp = out_file + "." + self.owner.replace(":", ".")
+        f = open(tmp, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(['action', 'username', 'result'])
+        for r in results:
+            writer.writerow(r[1:])
+        f.close()
+        os.rename(tmp, out_file)
+        logging.info("merged {0} results into {1}" \
+                        .format(len(results), out_file))
+
+
+def partitionKeys(rows):
+    """Partition key of each input row: the first name of its user, 
+    following renames, so all rows of a user share a partition"""
+
+    first = {}
+
+    def find(name):
+        while first.get(name, name) != name:
+            name = first[name]
+        return name
+
+    keys = []
+    for row in rows:
+        names = [row.get("username") or "", row.get("newusername") or ""]
+        roots = [find(name) for name in names]
+        for root in roots[1:]:
+            if root != roots[0]:
+                first[root] = roots[0]
+        keys.append(roots[0])
+
+    # A later rename may have joined two users
+    return [find(key) for key in keys]
+
+
+class ReconnectingLDAP(object):
+    """LDAP connection that rebinds and retries the 
+    failed operation when the connection is lost. With asynchronous 
+    operations in flight it rebinds but does not retry: their 
+    results are lost, the caller has to send them again."""
+
+    # Operations that return a message id, and the ones that 
+    # take it to collect the result
+    ASYNC = ['add', 'add_ext', 'compare', 'compare_ext', 'delete', 
+             'delete_ext', 'modify', 'modify_ext', 'modrdn', 'rename', 
+             'search', 'search_ext']
+    RESULTS = ['result', 'result2', 'result3', 'result4']
+
+    def __init__(self, ldap_server, ldap_user, ldap_secret, reconnects, 
+                 reconnect_delay, network_timeout=None, op_timeout=None, 
+                 tls=None):
+        self.ldap_server = ldap_server
+        self.ldap_user = ldap_user
+        self.ldap_secret = ldap_secret
+        self.reconnects = reconnects
+        self.reconnect_delay = reconnect_delay
+        self.network_timeout = network_timeout
+        self.op_timeout = op_timeout
+        self.tls = tls
+        # Set when the last operation had to be retried after a rebind, 
+        # so callers can tell "already done" results from real errors
+        self.retried = False
+        # Set when an operation timed out and may still be outstanding
+        self.stale = False
+        # Message ids of asynchronous operations waiting for their result
+        self.inflight = set()
+        self.l = None
+        self.bind()
+
+    def bind(self):
+        """Open a connection and bind with a user 
+        that has rights to add/update objects"""
+
+        # Let go of a lost or timed out connection first, 
+        # so its socket is not left open
+        if self.l:
+            try:
+                self.l.unbind_s()
+            except ldap.LDAPError:
+                pass
+
+        l = ldap.initialize(self.ldap_server)
+        l.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
+        # Don't let a dead server or a hung operation stall the run
+        if self.network_timeout:
+            l.set_option(ldap.OPT_NETWORK_TIMEOUT, self.network_timeout)
+        if self.op_timeout:
+            l.set_option(ldap.OPT_TIMEOUT, self.op_timeout)
+            l.timeout = self.op_timeout
+        bind = lambda: l.simple_bind_s(self.ldap_user, self.ldap_secret)
+        if self.tls:
+            self.tls.handshake(l, self.ldap_server, bind)
+        else:
+            bind()
+        self.l = l
+        self.stale = False
+        self.inflight = set()
+
+    def __getattr__(self, name):
+        attr = getattr(self.l, name)
+
+        # Only wrap the LDAP operations, and never retry an unbind
+        if not callable(attr) or name.startswith('unbind'):
+            return attr
+
+        def operation(*args, **kwargs):
+            self.retried = False
+            attempt = 0
+            while True:
+                try:
+                    # Start over on a fresh connection after 
+                    # a timeout or a lost connection
+                    if self.stale:
+                        self.bind()
+                    result = getattr(self.l, name)(*args, **kwargs)
+                except ldap.TIMEOUT:
+                    logging.warning("LDAP {0} timed out after {1}s" \
+                                    .format(name, self.op_timeout))
+                    self.stale = True
+                    raise
+                except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR), e:
+                    attempt += 1
+                    self.stale = True
+                    if self.inflight:
+                        logging.warning("lost LDAP connection during {0} " \
+                                        "({1}) with {2} operations in " \
+                                        "flight".format(name, e, 
+                                                        len(self.inflight)))
+                        self.inflight = set()
+                        raise
+                    if attempt > self.reconnects:
+                        raise
+                    logging.warning("lost LDAP connection during {0} " \
+                                    "({1}), reconnecting - attempt {2}" \
+                                    .format(name, e, attempt))
+                    time.sleep(self.reconnect_delay * attempt)
+                    self.retried = True
+                    continue
+                except ldap.LDAPError:
+                    # An error result collects the message id too
+                    if name in self.RESULTS and args:
+                        self.inflight.discard(args[0])
+                    raise
+
+                if name in self.ASYNC:
+                    self.inflight.add(result)
+                elif name in self.RESULTS and args:
+                    self.inflight.discard(args[0])
+                return result
 
+        return operation
+
+
+class TLSContext(object):
+    """TLS options of our LDAP connections, and how many 
+    handshakes they cost. The options are set on each connection, 
+    so Provisioners for different trees in one process keep their 
+    own. There is no TLS session resumption (python-ldap has no 
+    way to hand a session to a new connection), every connection 
+    pays for a full handshake, which is why all actions of a run 
+    share one connection."""
+
+    # TLSREQUIRECERT values
+    REQUIRECERT = {'never': 'OPT_X_TLS_NEVER', 'allow': 'OPT_X_TLS_ALLOW', 
+                   'try': 'OPT_X_TLS_TRY', 'demand': 'OPT_X_TLS_DEMAND', 
+                   'hard': 'OPT_X_TLS_HARD'}
+
+    def __init__(self, cacertfile, certfile, keyfile, requirecert, starttls):
+        self.cacertfile = cacertfile
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.requirecert = requirecert
+        self.starttls = starttls
+        self.handshakes = 0
+        self.elapsed = 0.0
+
+    def setup(self, l):
+        """Set the TLS options on a new connection, before it connects"""
+
+        if self.cacertfile:
+            l.set_option(ldap.OPT_X_TLS_CACERTFILE, self.cacertfile)
+        if self.certfile:
+            l.set_option(ldap.OPT_X_TLS_CERTFILE, self.certfile)
+        if self.keyfile:
+            l.set_option(ldap.OPT_X_TLS_KEYFILE, self.keyfile)
+        if self.requirecert:
+            l.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, 
+                getattr(ldap, self.REQUIRECERT[self.requirecert.lower()]))
+        # Build the connection's own TLS context from the options above, 
+        # instead of using the process-wide default one
+        l.set_option(ldap.OPT_X_TLS_NEWCTX, 0)
+
+    def handshake(self, l, ldap_server, bind):
+        """Secure a new connection (StartTLS or ldaps://) 
+        and bind, timing the TLS handshake"""
+
+        ldaps = ldap_server.lower().startswith("ldaps://")
+        if not (ldaps or self.starttls):
+            return bind()
+
+        self.setup(l)
+        start = time.time()
+        if ldaps:
+            # The handshake happens when the bind opens the connection
+            bind()
+        else:
+            l.start_tls_s()
+        elapsed = time.time() - start
+        self.handshakes += 1
+        self.elapsed += elapsed
+        logging.debug("TLS handshake with {0}: {1:.4f}s" \
+                        .format(ldap_server, elapsed))
+        if not ldaps:
+            bind()
+
+
+class Profiler(object):
+    """--profile mode: runs the batch under cProfile and a stack 
+    sampler, and times each action type and helper in wall time 
+    (which includes waiting on the network). Their CPU time is 
+    listed apart: it is process CPU time, so it also counts the 
+    sampler thread and other threads."""
+
+    # Helpers timed on their own, Provisioner methods and module functions
+    METHODS = ['ldapConnect', 'findUser', 'getUser', 'disabledCheck', 
+               'checkIds', 'loadIdIndex', 'reconcileGroups', 'requestSpace', 
+               'sendMail']
+    FUNCTIONS = ['addMember', 'isMember', 'delMember', 'delMemberUid', 
+                 'modifyStep']
+    # Seconds between stack samples
+    INTERVAL = 0.005
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.profile = cProfile.Profile()
+        # Name -> [calls, wall, cpu]
+        self.timings = {}
+        # Folded stack -> samples
+        self.stacks = {}
+        self.functions = {}
+        self.sampler = None
+        self.running = False
+        self.wrappers = set()
+
+    def timed(self, name, func):
+        """Wrap func to add its wall time (and process CPU time) to name"""
+
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            cpu = time.clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.time() - start, time.clock() - cpu)
+        return wrapper
+
+    def add(self, name, wall, cpu):
+        timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += wall
+        timing[2] += cpu
+
+    def start(self, provisioner):
+        """Start timing the actions and helpers of a provisioner"""
+
+        runAction = provisioner.runAction
+        def timedAction(action):
+            return self.timed("action " + action.action, runAction)(action)
+        provisioner.runAction = timedAction
+        self.wrappers = set([timedAction.func_code, 
+                             self.timed('', None).func_code])
+        for name in self.METHODS:
+            setattr(provisioner, name, 
+                    self.timed(name, getattr(provisioner, name)))
+        # Module functions are looked up by name when they are called
+        for name in self.FUNCTIONS:
+            self.functions[name] = globals()[name]
+            globals()[name] = self.timed(name, self.functions[name])
+
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, 
+                                        args=(threading.current_thread() \
+                                                .ident,))
+        self.sampler.daemon = True
+        self.sampler.start()
+        self.profile.enable()
+
+    def sample(self, thread):
+        """Count the stacks of the profiled thread every INTERVAL 
+        of wall time, so time spent waiting shows up too"""
+
+        while self.running:
+            frame = sys._current_frames().get(thread)
+            stack = []
+            while frame:
+                code = frame.f_code
+                # Leave our own timing wrappers out
+                if code not in self.wrappers:
+                    stack.append("{0}:{1}".format(
+                        frame.f_globals.get('__name__', '?'), code.co_name))
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.INTERVAL)
+
+    def stop(self, provisioner):
+        """Stop profiling and write the reports"""
+
+        self.profile.disable()
+        self.running = False
+        self.sampler.join()
+        for name in ['runAction'] + self.METHODS:
+            delattr(provisioner, name)
+        for name, func in self.functions.items():
+            globals()[name] = func
+
+        self.report()
+
+    def report(self):
+        """Write the hotspot report (PREFIX.txt) and the 
+        collapsed stacks for flame graphs (PREFIX.folded)"""
+
+        report = self.prefix + ".txt"
+        f = open(report, 'w')
+        f.write("{0:24} {1:>8} {2:>10} {3:>10} {4:>14}\n".format(
+                "action/helper", "calls", "wall", "wall/call", 
+                "process cpu"))
+        for name, (calls, wall, cpu) in sorted(self.timings.items(), 
+                                            key=lambda t: -t[1][1]):
+            f.write("{0:24} {1:8} {2:10.3f} {3:10.4f} {4:14.3f}\n".format(
+                    name, calls, wall, wall / calls, cpu))
+        f.write("\nwall: seconds spent in the action/helper, including " \
+                "waiting on LDAP/HTTP/SMTP\nprocess cpu: CPU seconds " \
+                "of the whole process meanwhile, sampler thread " \
+                "included\n\n")
+        stats = pstats.Stats(self.profile, stream=f)
+        stats.sort_stats('cumulative').print_stats(40)
+        stats.sort_stats('tottime').print_stats(40)
+        f.close()
+
+        folded = self.prefix + ".folded"
+        f = open(folded, 'w')
+        for stack, count in sorted(self.stacks.items()):
+            f.write("{0} {1}\n".format(stack, count))
+        f.close()
+
+        print("PROFILE: wrote {0} and {1}".format(report, folded))
+        logging.info("wrote profile reports {0} and {1}" \
+                        .format(report, folded))
+
+
+class Recorder(object):
+    """--record mode: writes every LDAP operation of the run with its 
+    timing and result to a trace file, one JSON object per line 
+    (gzipped if the name ends in .gz), for replay.py"""
+
+    # Attributes whose values never go into a trace
+    REDACT = ['userpassword']
+
+    def __init__(self, trace_file, server):
+        if trace_file.endswith(".gz"):
+            self.f = gzip.open(trace_file, 'wb')
+        else:
+            self.f = open(trace_file, 'wb')
+        self.trace_file = trace_file
+        self.start = time.time()
+        self.count = 0
+        # Usernames of the row being run (old and new of a rename), 
+        # replay.py keeps the operations of one user in order
+        self.users = None
+        self.write({"trace": 1, "server": server, 
+                    "start": time.strftime("%Y-%m-%dT%H:%M:%S", 
+                                            time.localtime(self.start))})
+
+    def write(self, record):
+        self.f.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def encode(self, value):
+        """JSON-safe copy of an operation argument, 
+        with the values of REDACT attributes hidden"""
+
+        if isinstance(value, (list, tuple)):
+            # (attr, values) of an add or (op, attr, value) of a modify
+            if len(value) > 1 and [v for v in value[:-1] if 
+                    isinstance(v, basestring) and v.lower() in self.REDACT]:
+                return [self.encode(v) for v in value[:-1]] + ["***"]
+            return [self.encode(v) for v in value]
+        if isinstance(value, dict):
+            return dict((k, self.encode(v)) for k, v in value.items())
+        if isinstance(value, ldap.controls.RequestControl):
+            ctrl = {"ctrl": value.controlType}
+            # Later pages of a paged search repeat the first one
+            if getattr(value, 'cookie', None):
+                ctrl["more"] = True
+            return ctrl
+        if isinstance(value, str):
+            try:
+                return value.decode('utf-8')
+            except UnicodeDecodeError:
+                return {"b64": base64.b64encode(value)}
+        if value is None or isinstance(value, (bool, int, long, float, 
+                                                unicode)):
+            return value
+        return repr(value)
+
+    def record(self, op, args, kwargs, start, elapsed, code, count=None, 
+               msgid=None):
+        """Add one operation to the trace: its start (t) and duration 
+        (d) in seconds, name, arguments, result code (r), entries 
+        returned (n), message id of an asynchronous operation (m) and 
+        the users of the row that made it (u)"""
+
+        record = {"t": round(start - self.start, 6), 
+                  "d": round(elapsed, 6), "op": op, 
+                  "a": self.encode(args), "r": code}
+        if count is not None:
+            record["n"] = count
+        if msgid is not None:
+            record["m"] = msgid
+        if kwargs:
+            record["k"] = self.encode(kwargs)
+        if self.users:
+            record["u"] = self.encode(self.users)
+        self.write(record)
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+        logging.info("recorded {0} LDAP operations to {1}" \
+                        .format(self.count, self.trace_file))
+
+
+class RecordingLDAP(object):
+    """LDAP connection for --record mode: passes every 
+    operation on and adds it to the trace"""
+
+    def __init__(self, l, recorder):
+        self.l = l
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        attr = getattr(self.l, name)
+        if not callable(attr):
+            return attr
+
+        def operation(*args, **kwargs):
+            start = time.time()
+            code = "OK"
+            count = None
+            msgid = None
+            try:
+                result = attr(*args, **kwargs)
+                # Number of entries a search (or result3) returned, or 
+                # the message id of an asynchronous operation (not the 
+                # 1/0 of compare_s)
+                if isinstance(result, list):
+                    count = len(result)
+                elif isinstance(result, tuple) and len(result) > 1 and \
+                        isinstance(result[1], list):
+                    count = len(result[1])
+                elif name in ReconnectingLDAP.ASYNC:
+                    msgid = result
+                return result
+            except ldap.LDAPError, e:
+                code = type(e).__name__
+                raise
+            finally:
+                self.recorder.record(name, args, kwargs, start, 
+                                        time.time() - start, code, count, 
+                                        msgid)
+
+        return operation
+
+
+class Planner(object):
+    """Collects the LDAP/HTTP/SMTP operations a batch 
+    would perform and estimates how long it would take"""
+
+    # Operation kinds in the order they are reported
+    KINDS = ['bind', 'search', 'compare', 'add', 'modify', 'rename', 
+             'delete', 'http', 'smtp']
+
+    def __init__(self, provisioner):
+        self.provisioner = provisioner
+        self.counts = dict((kind, 0) for kind in self.KINDS)
+        self.latency = dict((kind, 0.0) for kind in self.KINDS)
+        self.ops = []
+        # Entries added, renamed or deleted by earlier planned rows 
+        # by cn, so later rows resolve against the planned state
+        self.overlay = {}
+        # Planned member values by the member's cn: (group dn, member dn) 
+        # -> True if added, False if deleted
+        self.members = {}
+        # Users renamed by earlier planned rows by (new) cn: their 
+        # planned dn and the dn the server still has them under
+        self.moved = {}
+        # Outputs of --ldif mode
+        self.ldif = None
+        self.requests = None
+        self.requests_file = None
+        # Without a server all users are unknown (e.g. initial loads)
+        self.offline = False
+
+    def exportTo(self, ldif_file, requests_file):
+        """Stream the planned changes to an LDIF file and 
+        the storage requests/notifications to a CSV file"""
+
+        self.ldif = LDIFStream(open(ldif_file, 'wb'))
+        logging.info("opened LDIF file: {0}".format(ldif_file))
+        self.requests_file = open(requests_file, 'wb')
+        self.requests = csv.writer(self.requests_file)
+        self.requests.writerow(['kind', 'target', 'subject', 'text'])
+        logging.info("opened requests file: {0}".format(requests_file))
+
+        # We can export creates without the server, 
+        # but any checks against eDir will fail
+        try:
+            self.provisioner.bind().unbind_s()
+        except ldap.LDAPError, e:
+            print("WARNING: no LDAP server, exporting without checks " \
+                    "against eDir: {0}".format(e))
+            logging.warning("exporting LDIF offline, LDAP bind " \
+                            "failed: {0}".format(e))
+            self.offline = True
 
-def buildDN(username):
-    """Function to construct FQN for a username"""
+    def close(self):
+        """Close the --ldif mode outputs"""
+
+        if self.ldif:
+            self.ldif.close()
+            self.requests_file.close()
+
+    def record(self, kind, target):
+        """Count an operation and add it to the current row"""
+
+        self.counts[kind] += 1
+        self.ops.append(kind + " " + target)
+
+    def request(self, kind, target, subject='', text=''):
+        """Record an HTTP request or email and 
+        list it in the --ldif requests file"""
+
+        self.record(kind, target)
+        if self.requests:
+            self.requests.writerow([kind, target, subject, text])
+
+    def startRow(self):
+        """Start collecting operations for the next input row"""
+
+        self.ops = []
+
+    def forget(self, action):
+        """Drop the planned state of a user with no rows left to run, 
+        so it only holds the users still in progress"""
+
+        for cn in set([action.username, action.newusername]):
+            self.overlay.pop(cn, None)
+            self.members.pop(cn, None)
+            self.moved.pop(cn, None)
+
+    def describeRow(self, result):
+        """Result column for a planned row"""
+
+        return "PLAN ({0}): {1}".format(result, "; ".join(self.ops))
+
+    def probe(self, samples=5):
+        """Measure per-operation latency with harmless requests"""
+
+        # LDAP bind and search
+        start = time.time()
+        l = self.provisioner.bind()
+        self.latency['bind'] = time.time() - start
+
+        start = time.time()
+        for _i in range(samples):
+            l.search_s(self.provisioner.baseDN, ldap.SCOPE_BASE, 
+                        "objectClass=*", ['dn'])
+        self.latency['search'] = (time.time() - start) / samples
+        l.unbind_s()
+
+        # We can't probe writes safely, scale the search latency instead
+        self.latency['compare'] = self.latency['search']
+        for kind in ['add', 'modify', 'rename', 'delete']:
+            self.latency[kind] = self.latency['search'] * \
+                                    self.provisioner.PLANWRITEFACTOR
+
+        # Connecting to the file server and mail server 
+        # is the bulk of an HTTP request or an email
+        try:
+            host = urlparse.urlparse(spaceURL("EMP", "")).hostname
+            start = time.time()
+            socket.create_connection((host, 80), 
+                                     self.provisioner.NETWORKTIMEOUT).close()
+            self.latency['http'] = time.time() - start
+        except Exception as e:
+            logging.warning("unable to probe the file server: {0}".format(e))
+
+        try:
+            start = time.time()
+            smtplib.SMTP(self.provisioner.MAILSERVER, 
+                            timeout=self.provisioner.NETWORKTIMEOUT).quit()
+            self.latency['smtp'] = time.time() - start
+        except Exception as e:
+            logging.warning("unable to probe the mail server: {0}".format(e))
+
+        for kind in self.KINDS:
+            logging.info("probed {0} latency: {1:.4f}s" \
+                            .format(kind, self.latency[kind]))
+
+    def report(self):
+        """Print and log the aggregate counts and runtime estimate"""
+
+        estimate = 0.0
+        for kind in self.KINDS:
+            estimate += self.counts[kind] * self.latency[kind]
+            print("PLAN: {0:8} {1}".format(kind, self.counts[kind]))
+            logging.info("planned {0} operations: {1}" \
+                            .format(kind, self.counts[kind]))
+
+        tls = self.provisioner.tls
+        if tls.handshakes:
+            print("PLAN: {0:8} {1} ({2:.3f}s)".format('tls', tls.handshakes, 
+                                                        tls.elapsed))
+        print("PLAN: estimated runtime {0:.0f}s".format(estimate))
+        logging.info("planned runtime estimate: {0:.0f}s".format(estimate))
+
+        return estimate
+
+
+class PlanLDAP(object):
+    """LDAP connection for --plan/--ldif mode: searches are answered 
+    from the server and the planned state, writes are recorded"""
+
+    # Attributes later rows check, the only ones we keep in the 
+    # planned state (which only holds the users with rows still to run)
+    KEEP = ['loginDisabled', 'x500UniqueIdentifier', 'businessCategory', 
+            'groupMembership']
+
+    def __init__(self, l, planner):
+        self.l = l
+        self.planner = planner
+        self.ldif = planner.ldif
+        self.baseDN = planner.provisioner.baseDN
+        self.useControls = planner.provisioner.USECONTROLS
+        self.retried = False
+
+    def lookup(self, cn):
+        """Current entry for a cn in the planned state"""
+
+        if cn in self.planner.overlay:
+            return self.planner.overlay[cn]
+        if not self.l:
+            return None
+        ldap_result = self.l.search_s(self.baseDN, ldap.SCOPE_SUBTREE, 
+                                        "cn=" + cn, self.KEEP)
+        if len(ldap_result) == 0:
+            return None
+        return ldap_result[0]
+
+    def entry(self, dn):
+        """Planned entry at a dn, noSuchObject if there is none"""
+
+        entry = self.lookup(dn.split(',')[0][3:])
+        if not entry or entry[0].lower() != dn.lower():
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', 
+                                        'matched': dn})
+        return entry
+
+    def search_s(self, base, scope, searchFilter, attributes=None):
+        if scope == ldap.SCOPE_BASE:
+            self.planner.record('search', base)
+            return [self.entry(base)]
+        self.planner.record('search', searchFilter)
+        cn = searchFilter[3:]
+        if searchFilter.startswith("cn=") and cn in self.planner.overlay:
+            entry = self.planner.overlay[cn]
+            if entry:
+                return [entry]
+            return []
+        if not self.l:
+            return []
+        return self.l.search_s(base, scope, searchFilter, attributes)
+
+    def member(self, gdn, dn):
+        """Check a member of a group in the planned state"""
+
+        cn = dn.split(',')[0][3:]
+        planned = self.planner.members.get(cn, {})
+        key = (gdn.lower(), dn.lower())
+        if key in planned:
+            return planned[key]
+        # Not a planned entry (e.g. renamed away)
+        if cn in self.planner.overlay:
+            entry = self.planner.overlay[cn]
+            if not entry or entry[0].lower() != dn.lower():
+                return False
+        if not self.l:
+            return False
+        # eDir moves member values along with a renamed user, so 
+        # the server still has them under the user's old dn
+        moved = self.planner.moved.get(cn)
+        if moved and moved[0] == dn.lower():
+            dn = moved[1]
+        return self.l.compare_s(gdn, 'member', dn)
+
+    def compare_s(self, dn, attr, value):
+        self.planner.record('compare', dn)
+        if attr == 'member':
+            return self.member(dn, value)
+        # Attributes only the server has
+        if attr not in self.KEEP:
+            if not self.l:
+                return False
+            return self.l.compare_s(dn, attr, value)
+        values = self.entry(dn)[1].get(attr, [])
+        return value.upper() in [v.upper() for v in values]
+
+    def add_s(self, dn, ldif):
+        self.planner.record('add', dn)
+        if self.useControls:
+            try:
+                self.entry(dn)
+                raise ldap.ALREADY_EXISTS({'desc': 'Already exists', 
+                                            'matched': dn})
+            except ldap.NO_SUCH_OBJECT:
+                pass
+        if self.ldif:
+            self.ldif.add(dn, ldif)
+        cn = dn.split(',')[0][3:]
+        self.planner.overlay[cn] = (dn, dict((attr, values) 
+                                    for attr, values in ldif 
+                                    if attr in self.KEEP))
+
+    def modify_s(self, dn, mod_attrs):
+        self.planner.record('modify', dn)
+        if self.ldif:
+            self.ldif.modify(dn, mod_attrs)
+        # Keep track of the member values of groups
+        for op, attr, value in mod_attrs:
+            if attr == 'member':
+                self.planner.members.setdefault(value.split(',')[0][3:], 
+                        {})[(dn.lower(), value.lower())] = op == ldap.MOD_ADD
+        # Keep track of attributes later rows may check (e.g. loginDisabled), 
+        # group memberships are only ever added or deleted so we skip them
+        cn = dn.split(',')[0][3:]
+        replaces = [mod for mod in mod_attrs if mod[0] == ldap.MOD_REPLACE]
+        if cn not in self.planner.overlay and not replaces:
+            return
+        entry = self.lookup(cn)
+        if not entry:
+            return
+        attrs = dict(entry[1])
+        for op, attr, value in mod_attrs:
+            if attr not in self.KEEP:
+                continue
+            values = attrs.get(attr, [])
+            if op == ldap.MOD_REPLACE:
+                values = [value]
+            elif op == ldap.MOD_ADD:
+                values = values + [value]
+            else:
+                values = [v for v in values if v != value]
+            attrs[attr] = values
+        self.planner.overlay[cn] = (entry[0], attrs)
+
+    def rename_s(self, dn, newrdn, newsuperior=None):
+        self.planner.record('rename', dn)
+        entry = self.entry(dn)
+        if not newsuperior:
+            newsuperior = dn.split(',', 1)[1]
+        if newrdn.lower() != dn.split(',')[0].lower() and \
+                self.lookup(newrdn[3:]):
+            raise ldap.ALREADY_EXISTS({'desc': 'Already exists', 
+                                        'matched': newrdn})
+        if self.ldif:
+            self.ldif.moddn(dn, newrdn, newsuperior)
+        cn = dn.split(',')[0][3:]
+        newdn = newrdn + ',' + newsuperior
+        self.planner.overlay[cn] = None
+        self.planner.overlay[newrdn[3:]] = (newdn, entry[1])
+        # eDir rewrites the member values of the user's groups, 
+        # so we do the same with the planned ones
+        planned = self.planner.members.pop(cn, {})
+        self.planner.members[newrdn[3:]] = dict(((gdn, newdn.lower() 
+                    if member == dn.lower() else member), value) 
+                    for (gdn, member), value in planned.items())
+        moved = self.planner.moved.pop(cn, None)
+        if not moved or moved[0] != dn.lower():
+            moved = (dn.lower(), dn)
+        self.planner.moved[newrdn[3:]] = (newdn.lower(), moved[1])
+
+    def rename_ext_s(self, dn, newrdn, newsuperior=None, serverctrls=None):
+        self.rename_s(dn, newrdn, newsuperior)
+
+    def delete_s(self, dn):
+        self.planner.record('delete', dn)
+        self.entry(dn)
+        if self.ldif:
+            self.ldif.delete(dn)
+        cn = dn.split(',')[0][3:]
+        self.planner.overlay[cn] = None
+        self.planner.members.pop(cn, None)
+        self.planner.moved.pop(cn, None)
+
+    def delete_ext_s(self, dn, serverctrls=None):
+        self.delete_s(dn)
+
+    def unbind_s(self):
+        if self.l:
+            self.l.unbind_s()
+
+
+class LDIFStream(object):
+    """Writes LDAP changes as LDIF change records, 
+    one record at a time as they are made"""
+
+    # Line length before folding, as in RFC 2849 examples
+    COLS = 76
+
+    def __init__(self, f):
+        self.f = f
+        self.f.write("version: 1\n\n")
+
+    def line(self, attr, value):
+        """Write an attr: value line, base64 encoded if not safe"""
+
+        value = str(value)
+        if value and (value[0] in " :<" or value[-1] == " " or 
+                      [c for c in value if not " " <= c <= "~"]):
+            text = attr + ":: " + base64.b64encode(value)
+        else:
+            text = attr + ": " + value
+
+        # Fold long lines, continuations start with a space
+        self.f.write(text[:self.COLS] + "\n")
+        for i in range(self.COLS, len(text), self.COLS - 1):
+            self.f.write(" " + text[i:i + self.COLS - 1] + "\n")
+
+    def add(self, dn, ldif):
+        self.line('dn', dn)
+        self.line('changetype', 'add')
+        for attr, values in ldif:
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                self.line(attr, value)
+        self.f.write("\n")
+
+    def modify(self, dn, mod_attrs):
+        ops = {ldap.MOD_ADD: 'add', ldap.MOD_DELETE: 'delete', 
+               ldap.MOD_REPLACE: 'replace'}
+        self.line('dn', dn)
+        self.line('changetype', 'modify')
+        for op, attr, values in mod_attrs:
+            if not isinstance(values, list):
+                values = [values]
+            self.line(ops[op], attr)
+            for value in values:
+                self.line(attr, value)
+            self.f.write("-\n")
+        self.f.write("\n")
+
+    def moddn(self, dn, newrdn, newsuperior=None):
+        self.line('dn', dn)
+        self.line('changetype', 'moddn')
+        self.line('newrdn', newrdn)
+        self.line('deleteoldrdn', '1')
+        if newsuperior:
+            self.line('newsuperior', newsuperior)
+        self.f.write("\n")
+
+    def delete(self, dn):
+        self.line('dn', dn)
+        self.line('changetype', 'delete')
+        self.f.write("\n")
+
+    def close(self):
+        self.f.close()
+
+
+def pagedSearch(l, base, scope, searchFilter, attributes, pagesize):
+    """Function to search with the Simple Paged Results control, 
+    yielding the (dn, attrs) results one page at a time"""
+
+    ctrl = ldap.controls.SimplePagedResultsControl(True, size=pagesize, 
+                                                    cookie='')
+    while True:
+        msgid = l.search_ext(base, scope, searchFilter, attributes, 
+                                serverctrls=[ctrl])
+        rtype, rdata, rmsgid, serverctrls = l.result3(msgid)
+        for dn, attrs in rdata:
+            # Skip search continuation references
+            if dn:
+                yield dn, attrs
+
+        # An empty cookie means this was the last page
+        cookie = ''
+        for sctrl in serverctrls:
+            if sctrl.controlType == ctrl.controlType:
+                cookie = sctrl.cookie
+        if not cookie:
+            break
+        ctrl.cookie = cookie
+
+
+def sameIdentity(entry, x500UniqueIdentifier):
+    """Check if an existing entry is the 
+    person with this x500UniqueIdentifier"""
+
+    if not entry:
+        return False
+
+    return x500UniqueIdentifier in entry[1].get('x500UniqueIdentifier', [])
+
+
+def assertionControl(attr, value):
+    """Function to build an LDAP Assertion control (RFC 4528) 
+    for an (attr=value) filter"""
+
+    def ber(tag, content):
+        # BER tag, length and content
+        length = len(content)
+        if length < 0x80:
+            return tag + chr(length) + content
+        octets = ''
+        while length:
+            octets = chr(length & 0xff) + octets
+            length >>= 8
+        return tag + chr(0x80 | len(octets)) + octets + content
+
+    # Filter ::= equalityMatch [3] AttributeValueAssertion
+    assertion = ber('\xa3', ber('\x04', attr) + ber('\x04', value))
+
+    return ldap.controls.RequestControl(ASSERTIONCONTROL, True, assertion)
+
+
+def userNotFound(username):
+    """Report a user that does not exist"""
+
+    print("ERROR: user does not exist: {0}".format(username))
+    logging.error("user does not exist: {0}".format(username))
+    result = "ERROR: user could not be found!"
+
+    return result
+
+
+def userNotDisabled(username):
+    """Report a user that is not disabled"""
+
+    print("ERROR: user is not disabled: {0}".format(username))
+    logging.error("user is not disabled: {0}".format(username))
+    result = "ERROR: user is not disabled!"
+
+    return result
+
+
+def userTaken(username, verb="create"):
+    """Report a username that already exists"""
+
+    print("ERROR: cannot {0} user - user already exists: {1}" \
+            .format(verb, username))
+    logging.error("cannot {0} user - user already exists: {1}" \
+            .format(verb, username))
+    result = "ERROR: username already taken!"
+
+    return result
 
-    # First check if emp or student or guest
-    userType = getUserType(username)
-    
-    if userType == "STU":
-        dn = "cn=" + username + STUDENTOU
-        logging.info("looks like we have a student here: {0}".format(username))
-    elif userType == "GST":
-        dn = "cn=" + username + GUESTOU
-        logging.info("looks like we have a guest here: {0}".format(username))
-    else:
-        dn="cn=" + username + EMPOU
-        logging.info("looks like we have an employee here: {0}".format(username))
 
-    return dn
- 
- 
 def addMember(l, gdn, dn):
     """Function to add members to a group"""
 
     try:
         mod_attrs = [( ldap.MOD_ADD, 'member', dn ), 
                     ( ldap.MOD_ADD, 'equivalentToMe', dn )]
-        l.modify_s(gdn, mod_attrs)
+        # A member already in the group counts as done
+        modifyStep(l, gdn, mod_attrs)
         
     except ldap.LDAPError, e:
         print("ERROR: cannot add member to group {0}, error: {1}" \
@@ -922,21 +3328,48 @@ def addMember(l, gdn, dn):
     return
 
 
+def isMember(l, gdn, dn):
+    """Function to check one member of a group, 
+    without reading the (large) member list"""
+
+    try:
+        return bool(l.compare_s(gdn, 'member', dn))
+
+    except ldap.NO_SUCH_OBJECT:
+        logging.warning("group {0} does not exist".format(gdn))
+
+    return False
+
+
+def delMember(l, gdn, dn):
+    """Function to remove members from a group"""
+
+    try:
+        mod_attrs = [( ldap.MOD_DELETE, 'member', dn ), 
+                    ( ldap.MOD_DELETE, 'equivalentToMe', dn )]
+        # A member already gone counts as done
+        modifyStep(l, gdn, mod_attrs)
+        logging.info("user {0} removed from eDir group {1}".format(dn, gdn))
+
+    except ldap.LDAPError, e:
+        print("ERROR: cannot remove member from group {0}, error: {1}" \
+                .format(gdn, e))
+        logging.error("problem removing user {0} from group {1}: {2}" \
+                .format(dn, gdn, e))
+
+    return
+
+
 def delMemberUid(l, gn, gdn, username):
     """Function to delete memberUid atribute"""
     
     try:
-        searchScope = ldap.SCOPE_SUBTREE
-        searchFilter = "cn=" + gn
-        ldap_result = l.search_s(baseDN, searchScope, searchFilter, 
-                                    ['memberUid'])
-
-        for member in ldap_result[0][1]['memberUid']:
-            if username == member:
-                mod_attrs = [ ( ldap.MOD_DELETE, 'memberUid', member ) ]
-                l.modify_s(gdn, mod_attrs)
-                logging.info("deleted old memberUid value {0} from group " \
-                                "{1}".format(member, gdn))
+        # Delete the value directly, a memberUid that 
+        # is already absent counts as done
+        mod_attrs = [ ( ldap.MOD_DELETE, 'memberUid', username ) ]
+        modifyStep(l, gdn, mod_attrs)
+        logging.info("deleted old memberUid value {0} from group " \
+                        "{1}".format(username, gdn))
     except ldap.LDAPError, e:
         print("ERROR: cannot delete memeberUid from group {0}, error: {1}" \
                 .format(gn, e))
@@ -946,30 +3379,42 @@ def delMemberUid(l, gn, gdn, username):
     return
 
 
-def sendMail(frm, to, subject, text):
-    """Function to send a notification email"""
-    
-    # Build the message body
-    message = textwrap.dedent("""\
-        From: {0}
-        To: {1}
-        Subject: {2}
-        {3}
-        """.format(frm, to, subject, text))
-    
+def modifyStep(l, dn, mod_attrs):
+    """Function to apply modifications as an idempotent step: 
+    values already added or already removed count as done"""
+
     try:
-        # Send the mail
-        mailserver = MAILSERVER
-        server = smtplib.SMTP(mailserver)
-        server.sendmail(frm, to, message)
-        server.quit()
-        
-    except Exception as e:
-        print("ERROR: unable to send email: {0}".format(e))
-        logging.error("unknown error while sending email: {0}".format(e))
-    
+        l.modify_s(dn, mod_attrs)
+
+    except (ldap.TYPE_OR_VALUE_EXISTS, ldap.NO_SUCH_ATTRIBUTE):
+        if len(mod_attrs) == 1:
+            logging.info("step already done for {0}: {1} {2}" \
+                            .format(dn, mod_attrs[0][1], mod_attrs[0][2]))
+            return
+        # Part of the change is in place, so apply it piece by piece
+        for mod in mod_attrs:
+            modifyStep(l, dn, [mod])
+
     return
 
 
+def spaceURL(userType, username):
+    """Function to build the request URL 
+    for user home/quota space"""
+
+    if userType == "STU":
+        fileserver = "stufileserver"
+    else:
+        fileserver = "empfileserver"
+
+    return "http://" + fileserver + ".domain.edu/cgi-bin/getspace.pl" \
+            "?username=" + username
+
+
 if __name__ == "__main__":
+    # A single action (e.g. from an IDM driver event) takes the fast path
+    if len(sys.argv) > 1 and sys.argv[1] in UserAction.REQUIRED:
+        sys.exit(runOne(sys.argv))
+    if len(sys.argv) > 1 and sys.argv[1] == "sweep":
+        sys.exit(runSweep(sys.argv))
     main(sys.argv)
@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+
+"""
+Replays a trace of LDAP operations recorded with edir.py --record
+against an in-memory stand-in directory, to load test changes with
+real workloads and no live server.
+
+Usage:
+    python replay.py trace.jsonl [--speed 1] [--concurrency 1]
+
+Options:
+    -h --help
+    --speed		Pace of the replay: 1 keeps the recorded timing,
+    			10 runs ten times faster, 0 as fast as possible
+    --concurrency	Number of client threads. The operations of
+    			one user always go to the same thread, in order.
+
+Before the replay the trace is played once against an empty directory
+to seed it: every entry and value the recorded run found in place
+(e.g. a user it modified, a memberUid it deleted) is added up front,
+so the replayed results match the recorded ones.
+
+The report lists per operation the count and the recorded and replayed
+latency, the throughput, how far the replay fell behind the recorded
+timing, and the operations whose result differs from the recorded one.
+
+The operations of one user are those of its rows (as recorded, old and
+new name of a rename are one user), or in traces without them and for
+the sweep those on its dn, following the dn across renames.
+
+Controls (e.g. the Assertion control, paging) are not evaluated: an
+operation with one runs as without it. The report counts them by
+control type.
+"""
+
+from __future__ import print_function
+import sys
+import json
+import gzip
+import time
+import base64
+import fnmatch
+import argparse
+import contextlib
+import threading
+import Queue
+import ldap
+
+# Recorded operations and the stand-in method that replays them,
+# the rest (binds, result/result3 of asynchronous ones) are skipped
+OPS = {
+    'search_s': 'search', 'search_ext': 'search', 'search_ext_s': 'search',
+    'add_s': 'add', 'add_ext_s': 'add',
+    'modify_s': 'modify', 'modify_ext_s': 'modify',
+    'rename': 'rename', 'rename_s': 'rename', 'rename_ext_s': 'rename',
+    'delete_s': 'delete', 'delete_ext': 'delete', 'delete_ext_s': 'delete',
+    'compare_s': 'compare', 'compare_ext_s': 'compare'
+}
+
+
+def readTrace(trace_file):
+    """Operations of a trace to replay, with the result of
+    asynchronous ones taken from their result() call"""
+
+    if trace_file.endswith(".gz"):
+        f = gzip.open(trace_file, 'rb')
+    else:
+        f = open(trace_file, 'rb')
+
+    records = []
+    # Message id -> operation waiting for its result() call
+    pending = {}
+    # First page of the current paged search
+    paged = None
+    for line in f:
+        record = json.loads(line)
+        if "trace" in record:
+            continue
+
+        if record["op"] in ('result', 'result3'):
+            started = pending.pop(record["a"][0] if record["a"] else None, 
+                                    None)
+            if started:
+                if record["r"] != "OK":
+                    started["r"] = record["r"]
+                if "n" in record:
+                    started["n"] = started.get("n", 0) + record["n"]
+            continue
+
+        # Later pages of a paged search repeat the first one, their 
+        # entries count for it
+        more = [c for c in (record.get("k") or {}).get("serverctrls") or []
+                if isinstance(c, dict) and c.get("more")]
+        target = paged if more else record
+        if record["op"] == 'search_ext' and not more:
+            paged = record
+        # Older traces have the 1/0 of compare_s as a message id too
+        if "m" in record and target and not record["op"].endswith("_s"):
+            pending[record["m"]] = target
+        if more or record["op"] not in OPS:
+            continue
+
+        record["a"] = decode(record["a"])
+        records.append(record)
+    f.close()
+
+    return records
+
+
+def decode(value):
+    """Operation argument as recorded, back in python-ldap form"""
+
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if isinstance(value, dict) and "b64" in value:
+        return base64.b64decode(value["b64"])
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def parseFilter(text):
+    """Parse an LDAP filter (e.g. (&(cn=jdoe)(loginDisabled=TRUE))
+    or cn=jdoe) into nested tuples for matches()"""
+
+    text = text.strip()
+    if not text.startswith("("):
+        text = "(" + text + ")"
+    node, _pos = parseItem(text, 0)
+    return node
+
+
+def parseItem(text, pos):
+    pos += 1
+    if text[pos] in "&|!":
+        kind = text[pos]
+        pos += 1
+        children = []
+        while text[pos] == "(":
+            child, pos = parseItem(text, pos)
+            children.append(child)
+        return (kind, children), pos + 1
+
+    end = text.index(")", pos)
+    item = text[pos:end]
+    for kind in ("<=", ">=", "~=", "="):
+        if kind in item:
+            attr, value = item.split(kind, 1)
+            return (kind, attr.lower(), value.lower()), end + 1
+    raise ValueError("bad filter: " + text)
+
+
+def matches(node, attrs):
+    """Check a parsed filter against the attributes of an entry"""
+
+    kind = node[0]
+    if kind == "&":
+        return all(matches(child, attrs) for child in node[1])
+    if kind == "|":
+        return any(matches(child, attrs) for child in node[1])
+    if kind == "!":
+        return not matches(node[1][0], attrs)
+
+    _kind, attr, value = node
+    if attr == "objectclass" and value == "*":
+        return True
+    values = [v.lower() for v in attrs.get(attr, [])]
+    if kind == "<=":
+        return any(v <= value for v in values)
+    if kind == ">=":
+        return any(v >= value for v in values)
+    if value == "*":
+        return bool(values)
+    if "*" in value:
+        return any(fnmatch.fnmatchcase(v, value) for v in values)
+    return value in values
+
+
+class Directory(object):
+    """In-memory stand-in for the LDAP server: entries by lowercase
+    dn, with lowercase attribute names and values in order"""
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        # Lock of each entry by lowercase dn, so writes to different
+        # entries and all reads run in parallel. Entries are replaced,
+        # never changed in place, so a read sees a whole one.
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def locked(self, *dns):
+        """Hold the locks of the entries at dns, taken in a fixed order"""
+
+        with self.lock:
+            locks = [self.locks.setdefault(key, threading.Lock())
+                        for key in sorted(set(dn.lower() for dn in dns))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def get(self, dn):
+        entry = self.entries.get(dn.lower())
+        if not entry:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object',
+                                        'matched': dn})
+        return entry
+
+    def put(self, dn, attrs=None):
+        """Add an (empty) entry with its rdn value"""
+
+        attr, value = dn.split(",")[0].split("=", 1)
+        attrs = attrs or {}
+        attrs.setdefault(attr.lower(), [value])
+        self.entries[dn.lower()] = (dn, attrs)
+
+    def search(self, base, scope, searchFilter="(objectClass=*)",
+               attrlist=None, *args):
+        # The root DSE, for the supported controls
+        if base == "":
+            return [("", {"supportedcontrol": []})]
+
+        node = parseFilter(searchFilter)
+        if scope == ldap.SCOPE_BASE:
+            candidates = [self.get(base)]
+        else:
+            self.get(base)
+            suffix = "," + base.lower()
+            depth = base.count(",") + 1
+            candidates = [entry for key, entry in self.entries.items()
+                            if key.endswith(suffix) and
+                            (scope == ldap.SCOPE_SUBTREE or
+                             key.count(",") == depth)]
+            if scope == ldap.SCOPE_SUBTREE:
+                candidates.append(self.get(base))
+
+        wanted = attrlist and [attr.lower() for attr in attrlist]
+        return [(dn, dict((attr, list(values))
+                    for attr, values in attrs.items()
+                    if not wanted or attr in wanted))
+                for dn, attrs in candidates if matches(node, attrs)]
+
+    def add(self, dn, modlist, *args):
+        with self.locked(dn):
+            if dn.lower() in self.entries:
+                raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+            self.put(dn, dict((attr.lower(), list(values)
+                        if isinstance(values, list) else [values])
+                        for attr, values in modlist))
+
+    def modify(self, dn, mod_attrs, *args):
+        with self.locked(dn):
+            self.modifyEntry(dn, mod_attrs)
+
+    def modifyEntry(self, dn, mod_attrs):
+        _dn, attrs = self.get(dn)
+        # A modify is all or nothing, so we work on a copy
+        changed = dict((attr, list(values)) for attr, values in attrs.items())
+        for op, attr, values in mod_attrs:
+            attr = attr.lower()
+            if values is not None and not isinstance(values, list):
+                values = [values]
+            current = changed.get(attr, [])
+            if op == ldap.MOD_ADD:
+                for value in values:
+                    if value in current:
+                        raise ldap.TYPE_OR_VALUE_EXISTS({'desc': attr})
+                    current.append(value)
+                changed[attr] = current
+            elif op == ldap.MOD_DELETE:
+                if not values:
+                    if attr not in changed:
+                        raise ldap.NO_SUCH_ATTRIBUTE({'desc': attr})
+                    del changed[attr]
+                    continue
+                for value in values:
+                    if value not in current:
+                        raise ldap.NO_SUCH_ATTRIBUTE({'desc': attr})
+                    current.remove(value)
+                changed[attr] = current
+            elif values:
+                changed[attr] = list(values)
+            else:
+                changed.pop(attr, None)
+        self.entries[dn.lower()] = (_dn, changed)
+
+    def rename(self, dn, newrdn, newsuperior=None, *args):
+        newdn = newdn_of(dn, newrdn, newsuperior)
+        with self.locked(dn, newdn):
+            _dn, attrs = self.get(dn)
+            if newdn.lower() in self.entries:
+                raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+            attrs = dict(attrs)
+            attr, value = newrdn.split("=", 1)
+            attrs[attr.lower()] = [value]
+            self.entries[newdn.lower()] = (newdn, attrs)
+            del self.entries[dn.lower()]
+
+    def delete(self, dn, *args):
+        with self.locked(dn):
+            self.get(dn)
+            del self.entries[dn.lower()]
+
+    def compare(self, dn, attr, value, *args):
+        _dn, attrs = self.get(dn)
+        return value.lower() in [v.lower() for v in attrs.get(attr.lower(),
+                                                                [])]
+
+
+def newdn_of(dn, newrdn, newsuperior=None):
+    """dn of an entry after a rename"""
+
+    return newrdn + "," + (newsuperior or dn.split(",", 1)[1])
+
+
+def run(directory, record):
+    """Replay one operation, returns its result code and entry count"""
+
+    args = record["a"]
+    try:
+        result = getattr(directory, OPS[record["op"]])(*args)
+    except ldap.LDAPError, e:
+        return type(e).__name__, None
+    return "OK", len(result) if isinstance(result, list) else None
+
+
+def userKeys(records):
+    """Key of the user each operation belongs to: the first name of its
+    rows, joined across renames, or else its dn as first seen,
+    followed across renames"""
+
+    # Name or dn -> the one it was joined with
+    first = {}
+
+    def find(key):
+        while key in first:
+            key = first[key]
+        return key
+
+    keys = []
+    for record in records:
+        if record.get("u"):
+            names = [find("u:" + name) for name in record["u"]]
+            for name in names[1:]:
+                if name != names[0]:
+                    first[name] = names[0]
+            keys.append(names[0])
+            continue
+
+        args = record["a"]
+        key = find("dn:" + args[0].lower())
+        if OPS[record["op"]] == "rename" and len(args) > 1:
+            newdn = "dn:" + newdn_of(args[0], args[1], len(args) > 2 and
+                                        args[2] or None).lower()
+            if find(newdn) != key:
+                first[find(newdn)] = key
+        keys.append(key)
+
+    # Users joined by a later rename go to one thread from the start
+    return [find(key) for key in keys]
+
+
+def seed(records):
+    """Directory the recorded run must have started from, found by
+    playing the trace once and adding what was missing"""
+
+    initial = Directory()
+    current = Directory()
+
+    for record in records:
+        # Each try fixes one thing, e.g. the entry and then a value
+        for _attempt in range(3):
+            code, _count = run(current, record)
+            if code == record["r"] or record["r"] != "OK":
+                break
+            if not repair(initial, current, record, code):
+                break
+
+    return initial
+
+
+def repair(initial, current, record, code):
+    """Add what an operation that succeeded in the recorded run
+    found in place, to the start and current state"""
+
+    args = record["a"]
+    dn = args[0]
+    if code == "NO_SUCH_OBJECT":
+        for directory in (initial, current):
+            if dn.lower() not in directory.entries:
+                directory.put(dn)
+        return True
+
+    if code == "NO_SUCH_ATTRIBUTE" and OPS[record["op"]] == "modify":
+        for op, attr, values in args[1]:
+            if op != ldap.MOD_DELETE:
+                continue
+            if values is not None and not isinstance(values, list):
+                values = [values]
+            for directory in (initial, current):
+                if dn.lower() not in directory.entries:
+                    directory.put(dn)
+                attrs = directory.entries[dn.lower()][1]
+                present = attrs.setdefault(attr.lower(), [])
+                for value in values or ["seeded"]:
+                    if value not in present:
+                        present.append(value)
+        return True
+
+    return False
+
+
+class Replayer(object):
+    """Plays operations against a directory from several threads,
+    on the recorded schedule (sped up by speed)"""
+
+    def __init__(self, directory, speed, concurrency):
+        self.directory = directory
+        self.speed = speed
+        self.concurrency = concurrency
+        # (record, code, count, latency, lag) of each operation
+        self.results = []
+
+    def worker(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            record, due = item
+            start = time.time()
+            code, count = run(self.directory, record)
+            latency = time.time() - start
+            self.results.append((record, code, count, latency,
+                                    max(0.0, start - due)))
+
+    def replay(self, records):
+        """Replay records, returns the elapsed time"""
+
+        queues = [Queue.Queue() for _i in range(self.concurrency)]
+        threads = [threading.Thread(target=self.worker, args=(queue,))
+                    for queue in queues]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        keys = userKeys(records)
+        slots = {}
+        start = time.time()
+        for record, key in zip(records, keys):
+            due = start
+            if self.speed:
+                due = start + record["t"] / self.speed
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            # Operations of one user keep their order
+            slot = slots.setdefault(key, len(slots) % self.concurrency)
+            queues[slot].put((record, due))
+
+        for queue in queues:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+        return time.time() - start
+
+    def report(self, elapsed):
+        """Print per operation latency, throughput and mismatches"""
+
+        byOp = {}
+        for record, _code, _count, latency, _lag in self.results:
+            byOp.setdefault(record["op"], []).append((record["d"], latency))
+
+        total = len(self.results)
+        print("replayed {0} operations in {1:.2f}s ({2:.0f} ops/s), " \
+                "speed {3}, concurrency {4}".format(total, elapsed,
+                total / elapsed if elapsed else 0, self.speed or "max",
+                self.concurrency))
+        print("{0:14} {1:>8} {2:>14} {3:>14} {4:>14}".format("operation",
+                "count", "recorded ms", "replayed ms", "replayed p95"))
+        for op, times in sorted(byOp.items()):
+            replayed = sorted(latency for _d, latency in times)
+            print("{0:14} {1:8} {2:14.3f} {3:14.3f} {4:14.3f}".format(op,
+                    len(times),
+                    sum(d for d, _latency in times) / len(times) * 1000,
+                    sum(replayed) / len(replayed) * 1000,
+                    replayed[int(len(replayed) * 0.95)] * 1000))
+
+        if self.speed and self.results:
+            print("behind schedule: up to {0:.1f}ms".format(
+                    max(lag for _r, _c, _n, _l, lag in self.results) * 1000))
+
+        differs = [(record, code) for record, code, _count, _l, _lag
+                    in self.results if code != record["r"]]
+        counts = [record for record, _code, count, _l, _lag in self.results
+                    if "n" in record and count is not None
+                    and count != record["n"]]
+        print("result differs: {0}, entry count differs: {1}" \
+                .format(len(differs), len(counts)))
+        for record, code in differs[:10]:
+            print("  {0:.3f}s {1} {2}: recorded {3}, replayed {4}".format(
+                    record["t"], record["op"], record["a"][0], record["r"],
+                    code))
+
+        # Recorded controls the replay ran the operation without
+        controls = {}
+        for record, _code, _count, _l, _lag in self.results:
+            for ctrl in (record.get("k") or {}).get("serverctrls") or []:
+                if isinstance(ctrl, dict) and "ctrl" in ctrl:
+                    controls[ctrl["ctrl"]] = controls.get(ctrl["ctrl"], 0) + 1
+        if controls:
+            print("controls not evaluated: {0}".format(", ".join(
+                    "{0} x{1}".format(ctrl, count)
+                    for ctrl, count in sorted(controls.items()))))
+
+
+def main(argv):
+    """This is the main body of the script"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", type=str,
+                        help="Trace file written by edir.py --record")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed, 1 as recorded, 0 as fast " \
+                        "as possible")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of client threads")
+    args = parser.parse_args(argv[1:])
+
+    records = readTrace(args.trace)
+    if not records:
+        print("ERROR: no operations to replay in {0}".format(args.trace))
+        return 1
+
+    start = time.time()
+    directory = seed(records)
+    print("seeded {0} entries in {1:.2f}s".format(len(directory.entries),
+                                                   time.time() - start))
+
+    replayer = Replayer(directory, args.speed, max(1, args.concurrency))
+    replayer.report(replayer.replay(records))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
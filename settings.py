@@ -50,3 +50,64 @@ FROM = ''
 TO = ''
 # Email server address, e.g. mail.domain.edu
 MAILSERVER = ''
+# How many times to rebind and retry an LDAP operation when 
+# the connection drops, e.g. 3
+RECONNECTS = 3
+# Seconds to wait before a rebind, multiplied by the attempt number, e.g. 2
+RECONNECTDELAY = 2
+# Estimated cost of an LDAP write relative to a probed search in --plan 
+# mode, e.g. 2.0
+PLANWRITEFACTOR = 2.0
+# Fold pre-checks into the writes: the LDAP Assertion control (if the server
+# supports it) or a compare for archive/delete/sweep, and a noSuchObject
+# result for update, e.g. True. Creates and renames always search the whole
+# tree for the cn, so a username taken in another ou (e.g. _Archive) is found.
+USECONTROLS = True
+# Order in which user actions run, lower first: disable (update with
+# loginDisabled=True, or delete), rename, update, create and archive.
+# Actions of the same user always run in input order, and results are
+# written in input order. Equal priorities give plain input order.
+PRIORITIES = {'disable': 0, 'rename': 1, 'update': 1, 'create': 2, 'archive': 3}
+# Seconds into the run by which a class should have started, after
+# that its actions go before all others, e.g. {'disable': 300}
+DEADLINES = {}
+# Check uidNumber/gidNumber of creates and updates against the tree and
+# the rest of the batch before any write, e.g. True
+IDCHECK = True
+# Page size of large searches (e.g. loading the uidNumber index), e.g. 500
+PAGESIZE = 500
+# Seconds a Provisioner keeps the uidNumber/gidNumber index and supported
+# controls it read, a batch started after that reads them again (for
+# long-lived processes), e.g. 300
+CACHETIME = 300
+# Seconds to wait for a TCP connection (LDAP, SMTP) before giving up, e.g. 10
+NETWORKTIMEOUT = 10
+# Seconds a single LDAP operation may take, after that it fails with a
+# timeout and the next operation starts on a fresh connection, e.g. 60
+OPTIMEOUT = 60
+# Seconds to wait for the fileserver to answer a storage request, e.g. 30
+HTTPTIMEOUT = 30
+# Use StartTLS on a plain ldap:// LDAPSERVER (port 389), e.g. True.
+# For an ldaps:// LDAPSERVER (port 636) TLS is always on.
+STARTTLS = False
+# CA certificate(s) to verify the LDAP server against, e.g. '/etc/ssl/certs/ca.pem'
+TLSCACERTFILE = ''
+# Client certificate and key, if the server asks for one
+TLSCERTFILE = ''
+TLSKEYFILE = ''
+# Server certificate check: never, allow, try, demand or hard, e.g. 'demand'
+TLSREQUIRECERT = 'demand'
+# Number of partitions an input file is split into with --spool, more
+# partitions than workers evens out their load, e.g. 16
+PARTITIONS = 16
+# Seconds a --spool lease lasts without renewal, before other workers take
+# over the partition. Workers renew it after every row and must agree on the
+# time within this margin (shared filesystem clocks), e.g. 300
+LEASETIME = 300
+# Seconds between checks for free partitions with --spool, e.g. 5
+LEASEPOLL = 5
+# Users disabled and unchanged for this many days are archived by
+# "edir.py sweep" (or deleted from _Archive with --purge), e.g. 30
+SWEEPDAYS = 30
+# Moves/deletes a sweep keeps in flight on the LDAP connection, e.g. 16
+SWEEPWINDOW = 16